@@ -0,0 +1,392 @@
+"""
+Module for benchmarking the tile engines on synthetic rasters
+
+Generates, fully offline, a GeoTIFF, a yearly series of GeoTIFFs and an xarray cube of the given
+size, band count and dtype, then runs `RasterTiles` (rasterio and xarray engines),
+`AnimatedTiles` (both engines) and `create_apngs` for every zoom range, execution mode and
+worker count. Every case runs in a fresh process, and its wall time, tiles per second, peak RSS
+and output bytes are appended to a JSON lines results file, by default in the work folder, e.g.:
+
+    python benchmarks/benchmark_tiles.py --size 4096 --zooms 0-8 0-10 --workers 1 4
+    python benchmarks/benchmark_tiles.py --size 4096 --zooms 0-8 \
+        --baseline /tmp/tile-benchmarks/results.jsonl
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parents[1] / "src"
+for path in (SRC, SRC / "animations"):
+    if str(path) not in sys.path:
+        sys.path.append(str(path))
+
+import numpy as np  # noqa: E402
+import rasterio  # noqa: E402
+import rioxarray  # noqa: E402, F401
+import xarray as xr  # noqa: E402
+from rasterio.transform import from_origin  # noqa: E402
+from rasterio.windows import Window  # noqa: E402
+
+CASES = ("raster-rasterio", "raster-xarray", "animated-rasterio", "animated-xarray", "apngs")
+# Extent of the synthetic data in EPSG:4326, about the size of South Sudan
+WEST, NORTH, EXTENT = 24.0, 12.5, 10.0
+# Rows generated at once when writing the GeoTIFFs
+STRIP_SIZE = 1024
+# Range of the single band values, used to rescale them
+VMIN, VMAX = 0, 100
+
+
+def nodata_value(dtype: str, bands: int) -> float | None:
+    """
+    Return the nodata value of the synthetic data, None for RGBA data, which has an alpha band.
+    """
+    if bands == 4:
+        return None
+    if np.issubdtype(np.dtype(dtype), np.integer):
+        return np.iinfo(dtype).max
+    return -9999.0
+
+
+def synthetic_strip(
+    size: int, row: int, rows: int, bands: int, dtype: str, seed: int
+) -> np.ndarray:
+    """
+    Return rows of a smooth synthetic field (bands, rows, cols), with nodata outside an ellipse.
+
+    The field is a sum of waves of random frequencies, so that tiles compress like real data,
+    and it only depends on the pixel coordinates, so that it can be generated in strips.
+
+    Args:
+        size (int): The number of rows and columns of the raster.
+        row (int): The first row of the strip.
+        rows (int): The number of rows of the strip.
+        bands (int): The number of bands, 4 for RGBA.
+        dtype (str): The data type.
+        seed (int): The seed of the waves.
+    """
+    rng = np.random.default_rng(seed)
+    y = (np.arange(row, row + rows)[:, None] + 0.5) / size
+    x = (np.arange(size)[None, :] + 0.5) / size
+    inside = (x - 0.5) ** 2 / 0.45**2 + (y - 0.5) ** 2 / 0.4**2 < 1
+
+    data = np.empty((bands, rows, size), dtype=dtype)
+    scale = VMAX if bands == 1 else 255
+    for band in range(bands):
+        field = np.zeros((rows, size))
+        for _ in range(4):
+            fx, fy, phase = rng.uniform(1, 12), rng.uniform(1, 12), rng.uniform(0, 2 * np.pi)
+            field += np.sin(2 * np.pi * (fx * x + fy * y) + phase)
+        data[band] = ((field / 8 + 0.5) * scale).astype(dtype)
+
+    if bands == 4:
+        data[3] = np.where(inside, 255, 0)
+    else:
+        data[:, ~inside] = nodata_value(dtype, bands)
+    return data
+
+
+def write_geotiff(path: Path, size: int, bands: int, dtype: str, seed: int):
+    """
+    Write a synthetic tiled GeoTIFF in EPSG:4326, in strips.
+    """
+    profile = {
+        "driver": "GTiff",
+        "height": size,
+        "width": size,
+        "count": bands,
+        "dtype": dtype,
+        "crs": "EPSG:4326",
+        "transform": from_origin(WEST, NORTH, EXTENT / size, EXTENT / size),
+        "nodata": nodata_value(dtype, bands),
+        "tiled": True,
+        "blockxsize": 512,
+        "blockysize": 512,
+        "compress": "deflate",
+    }
+    with rasterio.open(path, "w", **profile) as dst:
+        for row in range(0, size, STRIP_SIZE):
+            rows = min(STRIP_SIZE, size - row)
+            window = Window(0, row, size, rows)
+            dst.write(synthetic_strip(size, row, rows, bands, dtype, seed), window=window)
+
+
+def synthetic_cube(size: int, steps: int, dtype: str, seed: int) -> xr.DataArray:
+    """
+    Return a synthetic single band cube (time, y, x) with rioxarray CRS and nodata.
+    """
+    data = np.stack(
+        [synthetic_strip(size, 0, size, 1, dtype, seed + step)[0] for step in range(steps)]
+    )
+    res = EXTENT / size
+    da = xr.DataArray(
+        data,
+        dims=("time", "y", "x"),
+        coords={
+            "time": np.arange(steps),
+            "y": NORTH - (np.arange(size) + 0.5) * res,
+            "x": WEST + (np.arange(size) + 0.5) * res,
+        },
+        name="synthetic",
+    )
+    return da.rio.write_crs("EPSG:4326").rio.write_nodata(nodata_value(dtype, 1))
+
+
+def prepare_data(workdir: Path, size: int, bands: int, dtype: str, steps: int, seed: int):
+    """
+    Write the synthetic GeoTIFF and yearly GeoTIFFs once, they are reused by later runs.
+
+    Returns:
+    tuple: The folder of the data, the GeoTIFF and the folder of the yearly GeoTIFFs.
+    """
+    folder = workdir / "data" / f"{size}px_{bands}b_{dtype}_{steps}t_seed{seed}"
+    geotiff, years = folder / "synthetic.tif", folder / "years"
+    if not (folder / "done").exists():
+        shutil.rmtree(folder, ignore_errors=True)
+        years.mkdir(parents=True)
+        write_geotiff(geotiff, size, bands, dtype, seed)
+        for step in range(steps):
+            write_geotiff(years / f"synthetic_{2000 + step}.tif", size, 1, dtype, seed + step)
+        (folder / "done").touch()
+    return folder, geotiff, years
+
+
+def output_bytes(folder: Path) -> int:
+    """
+    Return the size of the tiles written in a folder, without the files of the run itself.
+    """
+    from helpers.tile_manifest import MANIFEST_FILE
+    from helpers.tile_timings import TIMINGS_FILE
+
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(folder)
+        for name in files
+        if name != TIMINGS_FILE and not name.startswith(MANIFEST_FILE)
+    )
+
+
+def peak_rss() -> tuple:
+    """
+    Return the peak resident memory, in bytes, of this process and of its largest child.
+    """
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == "darwin" else 1024
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit,
+    )
+
+
+def run_case(params: dict, results: mp.Queue):
+    """
+    Run a benchmark case and put its metrics in the queue. Meant to run in a fresh process.
+
+    Args:
+        params (dict): The case, data and engine parameters.
+        results (multiprocessing.Queue): The queue of the metrics.
+    """
+    from animated_tiles import AnimatedTiles
+    from utils import create_apngs, create_linear_segmented_colormap
+
+    from helpers.raster_tiles import RasterTiles
+    from helpers.tile_timings import TIMINGS_FILE
+
+    case, output = params["case"], Path(params["output"])
+    shutil.rmtree(output, ignore_errors=True)
+    min_z, max_z = params["min_z"], params["max_z"]
+    options = {
+        "color_map": create_linear_segmented_colormap(["#b9de5a", "#0cb627", "#20234b"]),
+        "vmin": VMIN,
+        "vmax": VMAX,
+        "execution": params["execution"],
+        "max_workers": params["workers"],
+    }
+    if params["bands"] != 1 and case == "raster-rasterio":
+        options.update(color_map=None, vmin=None, vmax=None)
+
+    if case == "raster-rasterio":
+        run = RasterTiles(
+            Path(params["geotiff"]), output, min_z, max_z, engine="rasterio", **options
+        )
+    elif case == "raster-xarray":
+        cube = synthetic_cube(params["size"], 1, params["dtype"], params["seed"])
+        run = RasterTiles(cube.isel(time=0), output, min_z, max_z, engine="xarray", **options)
+    elif case == "animated-rasterio":
+        run = AnimatedTiles(params["years"], output, min_z, max_z, engine="rasterio", **options)
+    elif case == "animated-xarray":
+        cube = synthetic_cube(params["size"], params["steps"], params["dtype"], params["seed"])
+        run = AnimatedTiles(cube, output, min_z, max_z, engine="xarray", **options)
+    else:
+        # Only the APNGs are timed, the frames are generated first
+        run = AnimatedTiles(params["years"], output, min_z, max_z, engine="rasterio", **options)
+        run.engine_instance.generate_tiles()
+
+    start = time.perf_counter()
+    if case == "apngs":
+        writer = run.engine_instance.writer
+        create_apngs(output, writer, execution=params["execution"], max_workers=params["workers"])
+        writer.close()
+        tiles = sum(counts.get("written", 0) for counts in writer.counts.values())
+    else:
+        run.create()
+        with open(output / TIMINGS_FILE) as f:
+            timings = json.load(f)
+        tiles = timings["apngs" if case.startswith("animated") else "tiles"]["total"]["written"]
+    wall = time.perf_counter() - start
+
+    rss, children_rss = peak_rss()
+    results.put(
+        {
+            "wall_s": round(wall, 3),
+            "tiles": tiles,
+            "tiles_per_second": round(tiles / wall, 2) if wall else 0,
+            "peak_rss_mb": round(rss / 2**20, 1),
+            "peak_children_rss_mb": round(children_rss / 2**20, 1),
+            "output_bytes": output_bytes(output),
+        }
+    )
+
+
+def case_key(record: dict) -> tuple:
+    """
+    Return the parameters identifying a case, to match it with its baseline.
+    """
+    keys = ("case", "size", "bands", "dtype", "steps", "min_z", "max_z", "execution", "workers")
+    return tuple(record[key] for key in keys)
+
+
+def git_commit() -> str | None:
+    """
+    Return the current git commit, if any.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=SRC,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(argv: list | None = None) -> argparse.Namespace:
+    """
+    Parse the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--size", type=int, default=2048, help="Rows and columns of the rasters")
+    parser.add_argument("--bands", type=int, default=1, choices=(1, 3, 4))
+    parser.add_argument("--dtype", default="float32")
+    parser.add_argument("--steps", type=int, default=3, help="Time steps of the animations")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--zooms", nargs="+", default=["0-8"], help="Zoom ranges, e.g. 0-8")
+    parser.add_argument("--execution", nargs="+", default=["thread"], choices=("thread", "process"))
+    parser.add_argument("--workers", nargs="+", type=int, default=[os.cpu_count() or 1])
+    parser.add_argument("--cases", nargs="+", default=list(CASES), choices=CASES)
+    parser.add_argument(
+        "--workdir",
+        type=Path,
+        default=Path(tempfile.gettempdir()) / "tile-benchmarks",
+        help="Folder of the synthetic data and of the tiles",
+    )
+    parser.add_argument(
+        "--results",
+        type=Path,
+        help="JSON lines file the results are appended to, results.jsonl in the workdir by default",
+    )
+    parser.add_argument("--baseline", type=Path, help="Results file to compare against")
+    args = parser.parse_args(argv)
+    # Outside of the repository, so that runs leave the working tree clean
+    args.results = args.results or args.workdir / "results.jsonl"
+    return args
+
+
+def main(argv: list | None = None):
+    """
+    Run every benchmark case, append the results and compare them with the baseline.
+    """
+    args = parse_args(argv)
+    print("Preparing the synthetic data ...")
+    _, geotiff, years = prepare_data(
+        args.workdir, args.size, args.bands, args.dtype, args.steps, args.seed
+    )
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            # The last record of every case is its baseline
+            baseline = {case_key(record): record for record in map(json.loads, f)}
+
+    run = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+    # Fresh processes, so that the peak RSS of every case is its own
+    context = mp.get_context("spawn")
+    args.results.parent.mkdir(parents=True, exist_ok=True)
+    for case in args.cases:
+        for zooms in args.zooms:
+            min_z, max_z = (int(z) for z in zooms.split("-"))
+            for execution in args.execution:
+                for workers in args.workers:
+                    params = {
+                        "case": case,
+                        "size": args.size,
+                        "bands": args.bands,
+                        "dtype": args.dtype,
+                        "steps": args.steps,
+                        "seed": args.seed,
+                        "min_z": min_z,
+                        "max_z": max_z,
+                        "execution": execution,
+                        "workers": workers,
+                        "geotiff": str(geotiff),
+                        "years": str(years),
+                        "output": str(args.workdir / "tiles" / case),
+                    }
+                    queue = context.Queue()
+                    process = context.Process(target=run_case, args=(params, queue))
+                    process.start()
+                    process.join()
+                    if process.exitcode != 0:
+                        print(f"{case} z{zooms} {execution} x{workers}: failed")
+                        continue
+
+                    record = {**run, **params, **queue.get()}
+                    for key in ("seed", "geotiff", "years", "output"):
+                        del record[key]
+                    with open(args.results, "a") as f:
+                        f.write(json.dumps(record) + "\n")
+
+                    line = (
+                        f"{case} z{zooms} {execution} x{workers}: {record['wall_s']} s, "
+                        f"{record['tiles_per_second']} tiles/s, "
+                        f"{record['peak_rss_mb']} MB peak RSS, {record['output_bytes']} bytes"
+                    )
+                    base = baseline.get(case_key(record))
+                    if base:
+                        line += (
+                            f" ({base['wall_s'] / record['wall_s']:.2f}x speed, "
+                            f"{record['peak_rss_mb'] / base['peak_rss_mb']:.2f}x RSS vs baseline)"
+                        )
+                    print(line)
+
+
+if __name__ == "__main__":
+    main()
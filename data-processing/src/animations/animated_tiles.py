@@ -2,21 +2,33 @@
 Module for creating animated tiles
 """
 
-import io
 import os
-from concurrent.futures import ThreadPoolExecutor
+import time
 from pathlib import Path
 
 import mercantile
 import numpy as np
 import rasterio
 import xarray as xr
-from PIL import Image
+from apng import APNG, PNG
+from helpers.tile_encoders import ColormapLUT, TileEncoder, render_image, render_images
+from helpers.tile_executors import EXECUTION_MODES, run_tile_jobs
+from helpers.tile_manifest import MANIFEST_FILE, TileManifest, fingerprint, source_token
+from helpers.tile_readers import ThreadLocalReaders, TileGather, TileIndex
+from helpers.tile_selection import (
+    CoverageMask,
+    TileFootprint,
+    native_zoom,
+    order_tiles,
+    select_tiles,
+)
+from helpers.tile_timings import TIMINGS_FILE, TileTimings, write_timings
+from helpers.tile_writers import get_tile_writer, is_empty
 from rio_tiler.colormap import ColorMapType
 from rio_tiler.errors import TileOutsideBounds
-from rio_tiler.io import Reader, XarrayReader
+from rio_tiler.models import ImageData
 from tqdm import tqdm
-from utils import create_apngs, get_files_with_years
+from utils import create_apngs, get_files_with_years, stack_vrt
 
 
 class AnimatedTiles:
@@ -32,6 +44,39 @@ class AnimatedTiles:
     vmin (float, optional): The minimum value for the colormap. Defaults to 0.
     vmax (float, optional): The maximum value for the colormap. Defaults to 30000.
     engine (str, optional): The engine to use. Defaults to "xarray".
+    execution (str, optional): "thread" for I/O-heavy sources or "process" for CPU-bound
+        rendering. Defaults to "thread".
+    max_workers (int, optional): The number of threads or processes. Defaults to the executor
+        default.
+    skip_empty (bool, optional): Do not write tiles whose frames are all fully transparent.
+        Defaults to False.
+    deduplicate (str, optional): Store identical APNGs once, None, "hardlink" or "manifest"
+        (duplicates listed in `duplicates.json` instead of written). Defaults to None.
+    output (str, optional): "directory" for `{z}/{x}/{y}.png` files, or "mbtiles" or "pmtiles"
+        for a single archive written in the output folder. Defaults to "directory".
+    tile_options (dict, optional): Pillow PNG save options of the frames, e.g.
+        `{"compress_level": 9}`. Defaults to None.
+    resume (bool, optional): Record the completed APNGs in a `manifest.sqlite` file in the output
+        folder and skip the tiles already completed with the same data and settings. Defaults to
+        False.
+    clip_geometry (geopandas.GeoDataFrame or shapely geometry, optional): Only generate the tiles
+        that intersect this geometry, e.g. the country boundary. Defaults to None.
+    coverage (bool, optional): Compute first a coarse mask of where any time step has data, and
+        skip the tiles without data together with all their descendants. Defaults to False.
+    native_zoom (bool, optional): Cap the maximum zoom at the native zoom of the source, derived
+        from its pixel size and CRS, so that `max_z` is only an upper bound. Clients overzoom the
+        top level. Defaults to False.
+    tile_major (bool, optional): Render all the time steps of a tile at once, in memory, and write
+        its APNG directly, instead of writing every time step as PNG frames that are assembled
+        into APNGs afterwards. Defaults to False.
+    time_stack (bool, optional): Rasterio engine only, read the yearly files through a VRT
+        stacking them as bands, so that every tile is read and warped once for all the years.
+        Implies `tile_major`. Falls back to reading the years one by one if the files are not
+        on the same grid. Defaults to False.
+    steps_per_job (int, optional): Xarray engine only, the number of time steps of a tile
+        rendered by a job, which share the source pixels of the tile. Defaults to None, all the
+        time steps of a tile in a job, split in even chunks when there are too few tiles to keep
+        every worker busy.
     """
 
     def __init__(
@@ -44,6 +89,19 @@ class AnimatedTiles:
         vmin: float = 0,
         vmax: float = 30000,
         engine: str = "xarray",
+        execution: str = "thread",
+        max_workers: int | None = None,
+        skip_empty: bool = False,
+        deduplicate: str | None = None,
+        output: str = "directory",
+        tile_options: dict | None = None,
+        resume: bool = False,
+        clip_geometry=None,
+        coverage: bool = False,
+        native_zoom: bool = False,
+        tile_major: bool = False,
+        time_stack: bool = False,
+        steps_per_job: int | None = None,
     ):
         """
         Initializes the AnimatedTiles class.
@@ -53,20 +111,62 @@ class AnimatedTiles:
         if not self.engine_class:
             raise ValueError(f"Unsupported engine: {engine}")
         self.engine_instance = self.engine_class(
-            data, output_folder, min_z, max_z, color_map, vmin, vmax
+            data,
+            output_folder,
+            min_z,
+            max_z,
+            color_map,
+            vmin,
+            vmax,
+            execution=execution,
+            max_workers=max_workers,
+            skip_empty=skip_empty,
+            deduplicate=deduplicate,
+            output=output,
+            tile_options=tile_options,
+            resume=resume,
+            clip_geometry=clip_geometry,
+            coverage=coverage,
+            native_zoom=native_zoom,
+            tile_major=tile_major,
+            time_stack=time_stack,
+            steps_per_job=steps_per_job,
         )
 
     def create(self, time_coord="time"):
         """
-        Create animated-tiles.
+        Create animated-tiles, and write the timings of every stage per zoom, of the frames and
+        of the APNGs, to `timings.json` in the output folder.
         """
         print("Creating tiles ...")
+        start = time.perf_counter()
         if self.engine == "rasterio":
             self.engine_instance.generate_tiles()
         elif self.engine == "xarray":
             self.engine_instance.generate_tiles(time_coord)
-        print("Creating APNGs")
-        create_apngs(self.engine_instance.output_folder)
+        writer = self.engine_instance.writer
+        if self.engine_instance.tile_major:
+            # The APNGs are already written
+            timings = {"apngs": self.engine_instance.timings}
+        else:
+            print("Creating APNGs")
+            apng_timings = TileTimings()
+            create_apngs(
+                self.engine_instance.output_folder,
+                writer,
+                apng_timings,
+                execution=self.engine_instance.execution,
+                max_workers=self.engine_instance.max_workers,
+            )
+            timings = {"frames": self.engine_instance.timings, "apngs": apng_timings}
+        writer.close()
+        if writer.manifest is not None:
+            writer.manifest.close()
+        for line in writer.report():
+            print(line)
+        path = Path(self.engine_instance.output_folder) / TIMINGS_FILE
+        write_timings(path, time.perf_counter() - start, **timings)
+        print(f"Timings written to {path}")
 
 
 # Define a base class for tile engines
@@ -76,6 +176,10 @@ class TileEngine:
     """
 
     TILE_SIZE = 256
+    # A power of 4, so that batches of tiles ordered along the curve cover square areas
+    BATCH_SIZE = 64
+    # Space-filling curve the tiles are scheduled along, "hilbert" or "morton"
+    TILE_ORDER = "hilbert"
 
     def __init__(
         self,
@@ -86,6 +190,19 @@ class TileEngine:
         color_map: ColorMapType | None = None,
         vmin: float = 0,
         vmax: float = 30000,
+        execution: str = "thread",
+        max_workers: int | None = None,
+        skip_empty: bool = False,
+        deduplicate: str | None = None,
+        output: str = "directory",
+        tile_options: dict | None = None,
+        resume: bool = False,
+        clip_geometry=None,
+        coverage: bool = False,
+        native_zoom: bool = False,
+        tile_major: bool = False,
+        time_stack: bool = False,
+        steps_per_job: int | None = None,
     ):
         """
         Initialize the BaseTiler class.
@@ -98,7 +215,24 @@ class TileEngine:
         color_map (dict or sequence, optional): RGBA Color Table dictionary or sequence.
         vmin (float): The minimum value for rescaling the data.
         vmax (float): The maximum value for rescaling the data.
+        execution (str): Either "thread" or "process".
+        max_workers (int, optional): The number of threads or processes.
+        skip_empty (bool): Do not write tiles whose frames are all fully transparent.
+        deduplicate (str, optional): Store identical APNGs once, either "hardlink" or "manifest".
+        output (str): Either "directory", "mbtiles" or "pmtiles".
+        tile_options (dict, optional): Pillow PNG save options of the frames.
+        resume (bool): Skip the tiles recorded as completed in the manifest.
+        clip_geometry (geopandas.GeoDataFrame or shapely geometry, optional): The geometry the
+            tiles must intersect.
+        coverage (bool): Skip the tiles without data according to a coarse mask of the source.
+        native_zoom (bool): Cap the maximum zoom at the native zoom of the source.
+        tile_major (bool): Render all the time steps of a tile at once and write its APNG.
+        time_stack (bool): Read all the years of a tile at once from a VRT, implies tile_major.
+        steps_per_job (int, optional): The time steps of a tile rendered by a job.
         """
+        if execution not in EXECUTION_MODES:
+            raise ValueError(f"Unsupported execution: {execution}")
+
         self.data = data
         self.output_folder = output_folder
         self.min_z = min_z
@@ -107,6 +241,189 @@ class TileEngine:
         self.color_map = color_map
         self.vmin = vmin
         self.vmax = vmax
+        # Compiled colormap and range, single band tiles are colored in one lookup
+        self.lut = (
+            ColormapLUT(color_map, vmin, vmax)
+            if ColormapLUT.supports(color_map, vmin, vmax)
+            else None
+        )
+        self.execution = execution
+        self.max_workers = max_workers
+        self.readers = None
+        self.timings = TileTimings()
+        # APNGs are assembled from the PNG frames as they are, without decoding them
+        self.encoder = TileEncoder("png", tile_options)
+        self.resume = resume
+        self.completed = set()
+        self.footprint = TileFootprint(clip_geometry) if clip_geometry is not None else None
+        self.coverage = coverage
+        self.coverage_mask = None
+        self.native_zoom = native_zoom
+        self.tile_major = tile_major
+        self.time_stack = time_stack
+        self.steps_per_job = steps_per_job
+        # Writer of the final APNGs, the frames are written by the engines
+        self.output = output
+        self.writer = get_tile_writer(output, output_folder, skip_empty, deduplicate)
+
+    def _open_manifest(self, *settings):
+        """
+        Load the tiles already completed and record the new ones, if resuming.
+
+        Args:
+            *settings: The settings of the engine that change the tiles.
+        """
+        if not self.resume:
+            return
+        manifest = TileManifest(
+            Path(self.output_folder) / MANIFEST_FILE,
+            fingerprint(
+                source_token(self.data),
+                self.color_map,
+                self.vmin,
+                self.vmax,
+                self.TILE_SIZE,
+                self.encoder.options,
+                # Tiles completed in another output, or skipped as empty, are not stored here
+                self.output,
+                self.writer.skip_empty,
+                self.writer.deduplicate,
+                *settings,
+            ),
+        )
+        self.completed = manifest.completed()
+        self.writer.manifest = manifest
+
+    def _tiles(self, bbox: list) -> list:
+        """
+        Return the tiles of every zoom that cover the bounding box, within the clipping geometry
+        and with data according to the coverage mask, sorted by zoom and along `TILE_ORDER`.
+        """
+        filters = [f.filter for f in (self.footprint, self.coverage_mask) if f is not None]
+        if filters:
+            tiles = select_tiles(bbox, self.zooms, filters)
+        else:
+            tiles = list(mercantile.tiles(*bbox, zooms=self.zooms))
+        return order_tiles(tiles, self.TILE_ORDER)
+
+    def _cap_zoom(self, native_z: int):
+        """
+        Cap the maximum zoom at the native zoom of the source, keeping at least the minimum zoom.
+        """
+        self.max_z = max(self.min_z, min(self.max_z, native_z))
+        self.zooms = list(np.arange(self.min_z, self.max_z + 1))
+        print(f"Native zoom {native_z}, generating zooms {self.min_z} to {self.max_z}")
+
+    def _write_frame(self, tile: mercantile.Tile, n: int, image):
+        """
+        Encode a frame of a tile as a PNG and write it as `{z}/{x}/{y}_{n}.png`.
+        """
+        with self.timings.stage(tile.z, "encode"):
+            payload = self.encoder.encode(image)
+        with self.timings.stage(tile.z, "write"):
+            number = "{:03d}".format(n)
+            tile_dir = os.path.join(self.output_folder, str(tile.z), str(tile.x))
+            tile_file = os.path.join(tile_dir, f"{tile.y}_{number}.png")
+            os.makedirs(tile_dir, exist_ok=True)
+            with open(tile_file, "wb") as f:
+                f.write(payload)
+        self.timings.count(tile.z, "bytes", len(payload))
+
+    def _create_tile_wrapper(self, tile):
+        raise NotImplementedError("This method should be implemented by subclasses.")
+
+    def _read_frames(self, tile: mercantile.Tile) -> list:
+        """
+        Read the data of a tile at every time step, raising TileOutsideBounds if it has none.
+        """
+        raise NotImplementedError("This method should be implemented by subclasses.")
+
+    def _create_apng(self, tile: mercantile.Tile):
+        """
+        Render every time step of a tile in memory and write its APNG.
+
+        Args:
+            tile (mercantile.Tile): A mercantile tile object.
+        """
+        with self.timings.stage(tile.z, "read"):
+            imgs = self._read_frames(tile)
+        # The frames of a tile are colored together, in a single lookup
+        with self.timings.stage(tile.z, "render"):
+            images = render_images(imgs, self.vmin, self.vmax, self.color_map, self.lut)
+        # A tile is empty only if every frame is fully transparent, and is not encoded if skipped
+        empty = self.writer.skip_empty and all(is_empty(image) for image in images)
+        payload = b""
+        if not empty:
+            with self.timings.stage(tile.z, "encode"):
+                apng = APNG()
+                for image in images:
+                    apng.append(PNG.from_bytes(self.encoder.encode(image)), delay=1)
+                payload = apng.to_bytes()
+        with self.timings.stage(tile.z, "write"):
+            self.writer.write(tile, payload, empty)
+        if not empty:
+            self.timings.count(tile.z, "bytes", len(payload))
+
+    def _create_apngs(self, tiles):
+        """
+        Generate a batch of APNGs, tile by tile.
+
+        Returns:
+        tuple: The number of tiles written, the number of tiles outside the data bounds and the
+            list of errors.
+        """
+        written, skipped, errors = 0, 0, []
+        for tile in tiles:
+            try:
+                self._create_apng(tile)
+                self.timings.count(tile.z, "written")
+                written += 1
+            except TileOutsideBounds:
+                self.timings.count(tile.z, "skipped")
+                skipped += 1
+            except Exception as e:
+                self.timings.count(tile.z, "errored")
+                errors.append(f"{tile}: {e}")
+        return written, skipped, errors
+
+    def _create_tiles(self, tiles):
+        """
+        Generate a batch of tiles.
+
+        Returns:
+        tuple: The number of tiles written, the number of tiles outside the data bounds and the
+            list of errors.
+        """
+        written, skipped, errors = 0, 0, []
+        for tile in tiles:
+            try:
+                self._create_tile_wrapper(tile)
+                self.timings.count(tile.z, "written")
+                written += 1
+            except TileOutsideBounds:
+                self.timings.count(tile.z, "skipped")
+                skipped += 1
+            except Exception as e:
+                self.timings.count(tile.z, "errored")
+                errors.append(f"{tile}: {e}")
+        return written, skipped, errors
+
+    def _run(self, tiles, method="_create_tiles", batch_size=None, progress=None):
+        """
+        Generate the tiles with the configured execution mode.
+        """
+        results = run_tile_jobs(
+            self,
+            tiles,
+            self.execution,
+            self.max_workers,
+            batch_size or self.BATCH_SIZE,
+            method=method,
+            progress=progress,
+        )
+        for _, _, errors in results:
+            for error in errors:
+                print(f"An error occurred while generating tiles: {error}")
 
     def generate_tiles(self, time_coord=None):
         """
@@ -130,6 +447,11 @@ class RasterioEngine(TileEngine):
             raise ValueError(
                 "For engine 'rasterio', 'data' must be a valid directory or file path."
             )
+        # One open reader per worker thread and yearly file, reused for all its tiles
+        self.readers = ThreadLocalReaders()
+        # Every frame of a tile comes from a single read of the stacked years
+        self.tile_major = self.tile_major or self.time_stack
+        self.stack = None
 
     def _create_tile(
         self,
@@ -153,31 +475,17 @@ class RasterioEngine(TileEngine):
             vmin (float): The minimum value for rescaling the data.
             vmax (float): The maximum value for rescaling the data.
         """
-        try:
-            with Reader(tif_file_path) as dst:
-                # Get the tile data and mask
-                img = dst.tile(tile.x, tile.y, tile.z, indexes=indexes, tilesize=self.TILE_SIZE)
-                # Convert the data to an image
-                if num_bands == 1:
-                    # Rescale the data linearly from 0-10000 to 0-255
-                    img.rescale(in_range=((self.vmin, self.vmax),), out_range=((0, 255),))
-                    # Apply colormap and create a PNG buffer
-                    buff = img.render(colormap=colormap, add_mask=True)
-                    # Open the image from the buffer
-                    image = Image.open(io.BytesIO(buff))
-                else:
-                    image = Image.fromarray(np.uint8(np.transpose(img.data, (1, 2, 0))))
-
-                # Save the image as a PNG
-                number = "{:03d}".format(n)
-                tile_dir = os.path.join(self.output_folder, str(tile.z), str(tile.x))
-                tile_file = os.path.join(tile_dir, f"{tile.y}_{number}.png")
-                os.makedirs(tile_dir, exist_ok=True)
-                image.save(tile_file, "PNG")
-        except TileOutsideBounds:
-            pass
-        except Exception as e:
-            print(f"An error occurred while generating tiles: {e}")
+        # Reuse the reader opened by this worker thread
+        dst = self.readers.get(tif_file_path)
+        # Get the tile data and mask
+        with self.timings.stage(tile.z, "read"):
+            img = dst.tile(tile.x, tile.y, tile.z, indexes=indexes, tilesize=self.TILE_SIZE)
+        # Convert the data to an image
+        # The compiled lookup table only holds the engine colormap
+        lut = self.lut if colormap is self.color_map else None
+        with self.timings.stage(tile.z, "render"):
+            image = render_image(img, self.vmin, self.vmax, colormap, lut)
+        self._write_frame(tile, n, image)
 
     def _create_tile_wrapper(self, tile):
         self._create_tile(
@@ -189,35 +497,82 @@ class RasterioEngine(TileEngine):
             colormap=self.color_map,
         )
 
+    def _read_frames(self, tile: mercantile.Tile) -> list:
+        if self.stack is not None:
+            img = self.readers.get(self.stack).tile(
+                tile.x, tile.y, tile.z, indexes=self.indexes, tilesize=self.TILE_SIZE
+            )
+            # Split the bands of the stack back into years
+            bands = img.count // len(self.tif_file_paths)
+            return [
+                ImageData(img.array[i : i + bands], bounds=img.bounds, crs=img.crs)
+                for i in range(0, img.count, bands)
+            ]
+
+        imgs = []
+        for tif_file_path in self.tif_file_paths:
+            try:
+                imgs.append(
+                    self.readers.get(tif_file_path).tile(
+                        tile.x, tile.y, tile.z, indexes=self.indexes, tilesize=self.TILE_SIZE
+                    )
+                )
+            except TileOutsideBounds:
+                # No frame for the years the tile is outside of
+                continue
+        if not imgs:
+            raise TileOutsideBounds(f"Tile {tile} is outside of every year")
+        return imgs
+
     def generate_tiles(self):
         """
         Generate tiles from a GeoTIFF files.
         """
         # Get a list of all files in the directory sorted by year
         sorted_files = get_files_with_years(self.data)
+        self.tif_file_paths = [os.path.join(self.data, f) for f, _ in sorted_files]
+        self._open_manifest()
+
+        # Open the first GeoTIFF file
+        with rasterio.open(self.tif_file_paths[0]) as src:
+            # Get the bounding box
+            bbox = list(src.bounds)
+            # Get the count of bands
+            self.num_bands = src.count
+
+        if self.native_zoom:
+            self._cap_zoom(native_zoom(self.tif_file_paths[0]))
+
+        if self.coverage:
+            # Tiles with data in any year
+            self.coverage_mask = CoverageMask.union(
+                [CoverageMask.from_raster(path) for path in self.tif_file_paths]
+            )
 
-        for self.n, sorted_file in tqdm(enumerate(sorted_files)):
-            # Get the GeoTIFF file
-            tif_file = sorted_file[0]
-            self.tif_file_path = os.path.join(self.data, tif_file)
+        # Calculate the tiles within the bounding box at the given zoom level
+        tiles = self._tiles(bbox)
+        tiles = [tile for tile in tiles if tile not in self.completed]
 
-            if self.n == 0:
-                # Open the GeoTIFF file
-                with rasterio.open(self.tif_file_path) as src:
-                    # Get the bounding box
-                    bbox = list(src.bounds)
-                    # Get the count of bands
-                    self.num_bands = src.count
+        # Set the indexes parameter based on the number of bands
+        self.indexes = (1, 2, 3, 4) if self.num_bands == 4 else None
 
-                # Calculate the tiles within the bounding box at the given zoom level
-                tiles = list(mercantile.tiles(bbox[0], bbox[1], bbox[2], bbox[3], zooms=self.zooms))
+        if self.time_stack:
+            self.stack = stack_vrt(self.tif_file_paths)
+            if self.stack is None:
+                print("The yearly files cannot be stacked, reading them one by one")
+            else:
+                # Every band of every year
+                self.indexes = None
 
-                # Set the indexes parameter based on the number of bands
-                self.indexes = (1, 2, 3, 4) if self.num_bands == 4 else None
+        if self.tile_major:
+            # Every year of a tile at once, readers stay open for the whole run
+            self._run(tiles, "_create_apngs")
+            return
 
-            # Using ThreadPoolExecutor to parallelize the process
-            with ThreadPoolExecutor() as executor:
-                executor.map(self._create_tile_wrapper, tiles)
+        for n, tif_file_path in tqdm(enumerate(self.tif_file_paths)):
+            self.n, self.tif_file_path = n, tif_file_path
+            # Parallelize the process, readers are closed once this year is done
+            self._run(tiles)
 
 
 # Define a class for the xarray engine
@@ -233,56 +588,74 @@ class XArrayEngine(TileEngine):
         super().__init__(*args, **kwargs)
         if not isinstance(self.data, xr.DataArray):
             raise ValueError("For engine 'xarray', 'data' must be an xarray.DataArray.")
+        # Every tile is reprojected once for all the time steps
+        self.gather = TileGather(self.data, self.TILE_SIZE)
 
     def _create_tile(
         self,
         tile: mercantile.Tile = None,
-        da: xr.DataArray = None,
+        index: TileIndex = None,
         n: int = 0,
         colormap: ColorMapType | None = None,
     ):
         """
-        Generate a PNG tile from a xarray DataArray using rio-tiler.
+        Generate a PNG tile of a time step of the xarray DataArray.
 
         Args:
             tile (mercantile.Tile): A mercantile tile object.
-            n (int): The index of the GeoTIFF file in the list of files.
-            num_bands (int): The number of bands in the GeoTIFF file.
-            indexes (int or sequence of int, optional): Band indexes.
+            index (TileIndex): The source pixels of the tile.
+            n (int): The index of the time step.
             colormap (dict or sequence, optional): RGBA Color Table dictionary or sequence.
-            vmin (float): The minimum value for rescaling the data.
-            vmax (float): The maximum value for rescaling the data.
         """
-        try:
-            with XarrayReader(da) as dst:
-                # Get the tile data and mask
-                img = dst.tile(tile.x, tile.y, tile.z, tilesize=self.TILE_SIZE)
-                # Convert the data to an image
-                # Rescale the data linearly from 0-10000 to 0-255
-                img.rescale(in_range=((self.vmin, self.vmax),), out_range=((0, 255),))
-                # Apply colormap and create a PNG buffer
-                buff = img.render(colormap=colormap, add_mask=True)
-                # Open the image from the buffer
-                image = Image.open(io.BytesIO(buff))
-
-                # Save the image as a PNG
-                number = "{:03d}".format(n)
-                tile_dir = os.path.join(self.output_folder, str(tile.z), str(tile.x))
-                tile_file = os.path.join(tile_dir, f"{tile.y}_{number}.png")
-                os.makedirs(tile_dir, exist_ok=True)
-                image.save(tile_file, "PNG")
-        except TileOutsideBounds:
-            pass
-        except Exception as e:
-            print(f"An error occurred while generating tiles: {e}")
+        # Get the tile data and mask
+        with self.timings.stage(tile.z, "read"):
+            img = self.gather.read(index, self.data.isel({self.time_coord: n}))
+        # Convert the data to an image
+        # The compiled lookup table only holds the engine colormap
+        lut = self.lut if colormap is self.color_map else None
+        with self.timings.stage(tile.z, "render"):
+            image = render_image(img, self.vmin, self.vmax, colormap, lut)
+        self._write_frame(tile, n, image)
+
+    def _create_frames(self, jobs):
+        """
+        Generate the frames of a batch of jobs, each rendered once for its tile and time step.
 
-    def _create_tile_wrapper(self, tile):
-        self._create_tile(
-            tile,
-            da=self.da,
-            n=self.n,
-            colormap=self.color_map,
-        )
+        Every job is a tile with a range of its time steps, which share the source pixels of the
+        tile.
+
+        Returns:
+        tuple: The number of frames written, the number of frames outside the data bounds and
+            the list of errors.
+        """
+        written, skipped, errors = 0, 0, []
+        for tile, steps in jobs:
+            try:
+                # The source pixels of the tile, for all the time steps of the job
+                with self.timings.stage(tile.z, "index"):
+                    index = self.gather.index(tile)
+            except TileOutsideBounds:
+                self.timings.count(tile.z, "skipped", len(steps))
+                skipped += len(steps)
+                continue
+            for n in steps:
+                try:
+                    self._create_tile(tile, index, n, colormap=self.color_map)
+                    self.timings.count(tile.z, "written")
+                    written += 1
+                except Exception as e:
+                    self.timings.count(tile.z, "errored")
+                    errors.append(f"{tile} at time step {n}: {e}")
+        return written, skipped, errors
+
+    def _read_frames(self, tile: mercantile.Tile) -> list:
+        img = self.gather.read(self.gather.index(tile), self.data.transpose(self.time_coord, ...))
+        # Split the bands back into time steps
+        bands = img.count // self.data.sizes[self.time_coord]
+        return [
+            ImageData(img.array[i : i + bands], bounds=img.bounds, crs=img.crs)
+            for i in range(0, img.count, bands)
+        ]
 
     def generate_tiles(self, time_coord="time"):
         """
@@ -292,20 +665,47 @@ class XArrayEngine(TileEngine):
         time_coords = self.data[time_coord].values
         # Get the bounding box
         bbox = list(self.data.rio.bounds())
+        if self.native_zoom:
+            self._cap_zoom(native_zoom(self.data.isel({time_coord: 0})))
+        if self.coverage:
+            # Tiles with data in any time step
+            self.coverage_mask = CoverageMask.from_dataarray(self.data)
 
         # Calculate the tiles within the bounding box at the given zoom level
-        tiles = list(mercantile.tiles(bbox[0], bbox[1], bbox[2], bbox[3], zooms=self.zooms))
-
-        for self.n in tqdm(range(len(time_coords))):
-            # Get the xarray DataArray
-            self.da = self.data.isel({time_coord: self.n})
-            for tile in tiles:
-                self._create_tile(
-                    tile,
-                    da=self.da,
-                    n=self.n,
-                    colormap=self.color_map,
-                )
-            # Using ThreadPoolExecutor to parallelize the process
-            with ThreadPoolExecutor() as executor:
-                executor.map(self._create_tile_wrapper, tiles)
+        tiles = self._tiles(bbox)
+        self._open_manifest(time_coord)
+        tiles = [tile for tile in tiles if tile not in self.completed]
+
+        self.time_coord = time_coord
+        if self.tile_major:
+            # Every time step of a tile at once
+            self._run(tiles, "_create_apngs")
+            return
+
+        # Parallelize across both the tiles and the time steps, every frame is rendered once.
+        # Batches hold at most `BATCH_SIZE` frames, of jobs that read the same chunks, and are
+        # small enough to give every worker several batches.
+        n_steps = len(time_coords)
+        workers = self.max_workers or os.cpu_count() or 1
+        size = self.steps_per_job or self._steps_per_job(len(tiles), n_steps, workers)
+        jobs = [
+            (tile, range(start, min(start + size, n_steps)))
+            for tile in tiles
+            for start in range(0, n_steps, size)
+        ]
+        with tqdm(total=len(tiles) * n_steps, unit="frame") as progress:
+            self._run(
+                jobs,
+                "_create_frames",
+                max(1, min(self.BATCH_SIZE // size, len(jobs) // (4 * workers))),
+                # Frames written, skipped or errored
+                lambda result: progress.update(result[0] + result[1] + len(result[2])),
+            )
+
+    def _steps_per_job(self, n_tiles: int, n_steps: int, workers: int) -> int:
+        """
+        Return the default number of time steps of a job: all of them, unless there are too few
+        tiles to give every worker several jobs.
+        """
+        chunks = min(n_steps, -(-4 * workers // max(n_tiles, 1)))
+        return max(1, -(-n_steps // max(chunks, 1)))
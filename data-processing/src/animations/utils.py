@@ -6,33 +6,143 @@ import os
 import re
 from pathlib import Path
 from typing import Dict, List, Tuple
+from xml.sax.saxutils import escape
 
 import matplotlib
+import mercantile
 import numpy as np
+import rasterio
 from apng import APNG
+from helpers.tile_executors import run_tile_jobs
+from helpers.tile_timings import TileTimings
+from helpers.tile_writers import DirectoryTileWriter, TileWriter, is_empty
+from PIL import Image
+from rasterio.dtypes import dtype_rev, typename_fwd
+from rasterio.enums import MaskFlags
 
 
-def create_apngs(tile_dir: Path):
+class _APNGAssembler:
+    """
+    Assembles the APNGs of batches of tiles from their PNG frames, as a tile job engine.
+
+    Attributes:
+    writer (TileWriter): The writer of the APNGs.
+    timings (TileTimings): Records the time spent reading the frames, encoding and writing.
+    """
+
+    # Tiles per batch, each holding all its frames while it is assembled
+    BATCH_SIZE = 16
+
+    def __init__(self, writer: TileWriter, timings: TileTimings):
+        """
+        Initializes the _APNGAssembler class.
+        """
+        self.writer = writer
+        self.timings = timings
+        self.readers = None
+
+    def _create_apng(self, tile: mercantile.Tile, png_files: list):
+        with self.timings.stage(tile.z, "read"):
+            # A tile is empty only if every frame is fully transparent
+            empty = self.writer.skip_empty and all(is_empty(Image.open(f)) for f in png_files)
+            # Create APNG
+            apng = APNG.from_files(png_files, delay=1)
+        with self.timings.stage(tile.z, "encode"):
+            payload = apng.to_bytes()
+        with self.timings.stage(tile.z, "write"):
+            self.writer.write(tile, payload, empty)
+        if not empty:
+            self.timings.count(tile.z, "bytes", len(payload))
+        # Remove PNGs
+        for file in png_files:
+            os.remove(file)
+
+    def _create_apngs(self, jobs):
+        """
+        Assemble a batch of APNGs.
+
+        Returns:
+        tuple: The number of APNGs written, 0 tiles skipped and the list of errors.
+        """
+        written, errors = 0, []
+        for tile, png_files in jobs:
+            try:
+                self._create_apng(tile, png_files)
+                self.timings.count(tile.z, "written")
+                written += 1
+            except Exception as e:
+                self.timings.count(tile.z, "errored")
+                errors.append(f"{tile}: {e}")
+        return written, 0, errors
+
+
+def frame_groups(tile_dir: Path):
+    """
+    Yield every tile of a folder of PNG frames with its frame files, in frame order.
+
+    The frames of each `{z}/{x}` folder are listed and grouped by tile in a single pass, one
+    folder at a time.
+
+    Args:
+        tile_dir (str): The folder of the `{z}/{x}/{y}_{n}.png` frames.
+    """
+    for z_dir in os.scandir(tile_dir):
+        if not (z_dir.is_dir() and z_dir.name.isdigit()):
+            continue
+        for x_dir in os.scandir(z_dir.path):
+            if not x_dir.is_dir():
+                continue
+            frames = {}
+            for entry in os.scandir(x_dir.path):
+                # Only the frames, not the APNGs of a previous run
+                y, sep, number = entry.name.partition(".")[0].partition("_")
+                if sep:
+                    frames.setdefault(y, []).append((int(number), entry.path))
+            for y, files in frames.items():
+                tile = mercantile.Tile(int(x_dir.name), int(y), int(z_dir.name))
+                yield tile, [path for _, path in sorted(files)]
+
+
+def create_apngs(
+    tile_dir: Path,
+    writer: TileWriter | None = None,
+    timings: TileTimings | None = None,
+    execution: str = "process",
+    max_workers: int | None = None,
+):
     """
     Create APNGs from the tiles.
 
+    The tiles are assembled in batches across a thread or process pool, streamed from the frame
+    folders so that only the batches in flight hold frames in memory.
+
     Attributes:
         tile_dir (str): The name of the local folder where the animated tiles will be exported.
+        writer (TileWriter, optional): The writer of the APNGs, it can skip empty tiles and
+            deduplicate them. Defaults to writing `{z}/{x}/{y}.png` files in `tile_dir`.
+        timings (TileTimings, optional): Records the time spent reading the frames, encoding
+            and writing every APNG. Defaults to None.
+        execution (str, optional): Either "thread" or "process". Defaults to "process".
+        max_workers (int, optional): The number of threads or processes. Defaults to the
+            executor default.
     """
-    for z_dir in os.listdir(tile_dir):
-        for x_dir in os.listdir(os.path.join(tile_dir, z_dir)):
-            file_names = os.listdir(os.path.join(tile_dir, z_dir, x_dir))
-
-            tiles = [x.split("_")[0] for x in file_names]
-            tiles = list(set(tiles))
-            for tile in tiles:
-                png_files = list(filter(lambda x: x.split("_")[0] == tile, file_names))
-                png_files = sorted(png_files, key=lambda x: float(x.split(".")[0]))
-                png_files = [os.path.join(tile_dir, z_dir, x_dir, i) for i in png_files]
-                # Create APNG
-                APNG.from_files(png_files, delay=1).save(png_files[0][:-8] + ".png")
-                # Remove PNGs
-                [os.remove(file) for file in png_files]
+    if writer is None:
+        writer = DirectoryTileWriter(tile_dir)
+    if timings is None:
+        timings = TileTimings()
+
+    assembler = _APNGAssembler(writer, timings)
+    results = run_tile_jobs(
+        assembler,
+        frame_groups(tile_dir),
+        execution,
+        max_workers,
+        assembler.BATCH_SIZE,
+        method="_create_apngs",
+    )
+    for _, _, errors in results:
+        for error in errors:
+            print(f"An error occurred while creating APNGs: {error}")
 
 
 def get_files_with_years(input_folder):
@@ -55,6 +165,54 @@ def get_files_with_years(input_folder):
     return sorted_files
 
 
+def stack_vrt(file_paths: list) -> str | None:
+    """
+    Return a VRT stacking the bands of the yearly files, year after year, so that a tile of
+    every year is read, and warped, at once.
+
+    The VRT is returned as XML, which rasterio and rio-tiler open as if it was a file path.
+
+    Args:
+        file_paths (list): The paths of the GeoTIFF files, sorted by year.
+
+    Returns:
+    str: The VRT, None if the files are not on the same grid, or if their bands are masked
+        otherwise than with a nodata value (e.g. an alpha band), as the VRT only keeps the
+        nodata values.
+    """
+    profiles = []
+    for path in file_paths:
+        with rasterio.open(path) as src:
+            if any(
+                flags not in ([MaskFlags.nodata], [MaskFlags.all_valid])
+                for flags in src.mask_flag_enums
+            ):
+                return None
+            profiles.append(
+                (src.crs, src.transform, src.width, src.height, src.dtypes, src.nodatavals)
+            )
+    crs, transform, width, height, _, _ = profiles[0]
+    if any(profile[:4] != profiles[0][:4] for profile in profiles):
+        return None
+
+    bands = []
+    for path, (*_, dtypes, nodatavals) in zip(file_paths, profiles, strict=True):
+        for band, (dtype, nodata) in enumerate(zip(dtypes, nodatavals, strict=True), 1):
+            nodata = f"<NoDataValue>{nodata!r}</NoDataValue>" if nodata is not None else ""
+            bands.append(
+                f'<VRTRasterBand dataType="{typename_fwd[dtype_rev[dtype]]}" '
+                f'band="{len(bands) + 1}">{nodata}<SimpleSource>'
+                f'<SourceFilename relativeToVRT="0">{escape(str(path))}</SourceFilename>'
+                f"<SourceBand>{band}</SourceBand></SimpleSource></VRTRasterBand>"
+            )
+    return (
+        f'<VRTDataset rasterXSize="{width}" rasterYSize="{height}">'
+        f"<SRS>{escape(crs.to_wkt())}</SRS>"
+        f"<GeoTransform>{', '.join(map(repr, transform.to_gdal()))}</GeoTransform>"
+        f"{''.join(bands)}</VRTDataset>"
+    )
+
+
 def create_linear_segmented_colormap(colors_list: List[str]) -> Dict[int, Tuple[int, int, int]]:
     """
     Create a linear segmented colormap.
@@ -0,0 +1,105 @@
+"""
+Module for caching rasterized zone masks on disk
+"""
+
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+
+
+def mask_key(vector_data: gpd.GeoDataFrame, x: np.ndarray, y: np.ndarray, *settings) -> str:
+    """
+    Return a hash of everything a mask depends on: the geometries, their zone numbers and CRS,
+    and the coordinates of the target grid.
+
+    Args:
+        vector_data (geopandas.GeoDataFrame): The zones, numbered by their "index" column.
+        x (numpy.ndarray): The x coordinates of the grid.
+        y (numpy.ndarray): The y coordinates of the grid.
+        *settings: The settings of the rasterization, with a stable `repr`.
+    """
+    key = hashlib.blake2b(digest_size=16)
+    key.update(repr((str(vector_data.crs), settings)).encode())
+    key.update(np.ascontiguousarray(vector_data["index"].to_numpy(), dtype=np.int64).tobytes())
+    for geometry in vector_data.geometry.to_wkb():
+        key.update(geometry or b"")
+    for coords in (x, y):
+        key.update(np.ascontiguousarray(coords, dtype=np.float64).tobytes())
+    return key.hexdigest()
+
+
+class MaskCache:
+    """
+    Keeps rasterized masks in a folder, as compressed NPZ files named by their key, and bounded
+    in bytes.
+
+    Masks are written aside and moved, so the folder can be shared by several processes. The
+    least recently used masks are removed first, by their modification time, which is
+    refreshed on every hit.
+
+    Attributes:
+    folder (str or Path): The folder of the cache.
+    max_size (int, optional): The maximum bytes of masks kept. Defaults to 1 GB.
+    """
+
+    def __init__(self, folder: Path, max_size: int = 2**30):
+        """
+        Initializes the MaskCache class.
+        """
+        self.folder = Path(folder)
+        self.max_size = max_size
+        os.makedirs(self.folder, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.folder / f"{key}.npz"
+
+    def get(self, key: str) -> dict | None:
+        """
+        Return the cached arrays of a mask, None if it is not cached.
+
+        Args:
+            key (str): The key of the mask.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+            os.utime(path)
+        except (FileNotFoundError, OSError, ValueError):
+            # Missing, evicted meanwhile or unreadable
+            return None
+        return arrays
+
+    def put(self, key: str, **arrays):
+        """
+        Cache the arrays of a mask and evict the least recently used masks beyond the size.
+
+        Args:
+            key (str): The key of the mask.
+            **arrays (numpy.ndarray): The arrays of the mask.
+        """
+        with tempfile.NamedTemporaryFile(dir=self.folder, suffix=".tmp", delete=False) as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(f.name, self._path(key))
+        self._evict()
+
+    def _evict(self):
+        files = []
+        for entry in os.scandir(self.folder):
+            if entry.name.endswith(".npz"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        size = sum(file_size for _, file_size, _ in files)
+        # The most recent mask is kept even if it is larger than the cache
+        for _, file_size, path in sorted(files)[:-1]:
+            if size <= self.max_size:
+                break
+            Path(path).unlink(missing_ok=True)
+            size -= file_size
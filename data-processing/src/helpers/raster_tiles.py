@@ -2,19 +2,34 @@
 Module for creating raster tiles
 """
 
-import io
 import os
-from concurrent.futures import ThreadPoolExecutor
+import time
 from pathlib import Path
 
 import mercantile
 import numpy as np
 import rasterio
 import xarray as xr
+from helpers.tile_encoders import ColormapLUT, TileEncoder, render_image, render_images
+from helpers.tile_executors import EXECUTION_MODES, run_tile_jobs
+from helpers.tile_manifest import MANIFEST_FILE, TileManifest, fingerprint, source_token
+from helpers.tile_pyramid import RESAMPLING_METHODS, downsample, mosaic_children
+from helpers.tile_readers import ThreadLocalReaders
+from helpers.tile_selection import (
+    CoverageMask,
+    TileFootprint,
+    intersects_bbox,
+    native_zoom,
+    order_tiles,
+    select_tiles,
+)
+from helpers.tile_timings import TIMINGS_FILE, TileTimings, write_timings
+from helpers.tile_writers import get_tile_writer, is_empty
 from PIL import Image
 from rio_tiler.colormap import ColorMapType
 from rio_tiler.errors import TileOutsideBounds
-from rio_tiler.io import Reader, XarrayReader
+from rio_tiler.io import XarrayReader
+from rio_tiler.models import ImageData
 
 
 class RasterTiles:
@@ -30,6 +45,34 @@ class RasterTiles:
     color_map (rio_tiler.colormap.ColorMapType, optional): The colormap to use. Defaults to None.
     vmin (float, optional): The minimum value for the colormap. Defaults to 0.
     vmax (float, optional): The maximum value for the colormap. Defaults to 30000.
+    execution (str, optional): "thread" for I/O-heavy sources or "process" for CPU-bound
+        rendering. Defaults to "thread".
+    max_workers (int, optional): The number of threads or processes. Defaults to the executor
+        default.
+    pyramid (bool, optional): Read only the maximum zoom from the source and build every lower
+        zoom from its children tiles. Defaults to False.
+    resampling (str, optional): The pyramid resampling, "average" for continuous data or "mode"
+        for categorical data. Defaults to "average".
+    skip_empty (bool, optional): Do not write fully transparent tiles. Defaults to False.
+    deduplicate (str, optional): Store identical tiles once, None, "hardlink" or "manifest"
+        (duplicates listed in `duplicates.json` instead of written). Defaults to None.
+    output (str, optional): "directory" for `{z}/{x}/{y}` tile files, or "mbtiles" or "pmtiles"
+        for a single archive written in the output folder. Defaults to "directory".
+    tile_format (str, optional): The tile encoding, "png", "webp" or "jpeg" (opaque layers only).
+        Defaults to "png".
+    tile_options (dict, optional): Pillow save options of the tile format, e.g.
+        `{"compress_level": 9}` for PNG or `{"lossless": True}` for WebP. Defaults to None.
+    resume (bool, optional): Record the completed tiles in a `manifest.sqlite` file in the output
+        folder and skip the tiles already completed with the same data and settings, so that an
+        interrupted run, or a run with new zoom levels, only generates the missing tiles.
+        Defaults to False.
+    clip_geometry (geopandas.GeoDataFrame or shapely geometry, optional): Only generate the tiles
+        that intersect this geometry, e.g. the country boundary. Defaults to None.
+    coverage (bool, optional): Compute first a coarse mask of where the source has data, and skip
+        the tiles without data together with all their descendants. Defaults to False.
+    native_zoom (bool, optional): Cap the maximum zoom at the native zoom of the source, derived
+        from its pixel size and CRS, so that `max_z` is only an upper bound. Clients overzoom the
+        top level. Defaults to False.
     """
 
     def __init__(
@@ -42,6 +85,19 @@ class RasterTiles:
         color_map: ColorMapType = None,
         vmin: float = None,
         vmax: float = None,
+        execution: str = "thread",
+        max_workers: int | None = None,
+        pyramid: bool = False,
+        resampling: str = "average",
+        skip_empty: bool = False,
+        deduplicate: str | None = None,
+        output: str = "directory",
+        tile_format: str = "png",
+        tile_options: dict | None = None,
+        resume: bool = False,
+        clip_geometry=None,
+        coverage: bool = False,
+        native_zoom: bool = False,
     ):
         """
         Initializes the RasterTiles class.
@@ -51,15 +107,39 @@ class RasterTiles:
         if not self.engine_class:
             raise ValueError(f"Unsupported engine: {engine}")
         self.engine_instance = self.engine_class(
-            data, output_folder, min_z, max_z, color_map, vmin, vmax
+            data,
+            output_folder,
+            min_z,
+            max_z,
+            color_map,
+            vmin,
+            vmax,
+            execution=execution,
+            max_workers=max_workers,
+            pyramid=pyramid,
+            resampling=resampling,
+            skip_empty=skip_empty,
+            deduplicate=deduplicate,
+            output=output,
+            tile_format=tile_format,
+            tile_options=tile_options,
+            resume=resume,
+            clip_geometry=clip_geometry,
+            coverage=coverage,
+            native_zoom=native_zoom,
         )
 
     def create(self, time_coord="time"):
         """
-        Create animated-tiles.
+        Create tiles, and write the timings of every stage per zoom to `timings.json`
+        in the output folder.
         """
         print("Creating tiles ...")
+        start = time.perf_counter()
         self.engine_instance.generate_tiles()
+        path = Path(self.engine_instance.output_folder) / TIMINGS_FILE
+        write_timings(path, time.perf_counter() - start, tiles=self.engine_instance.timings)
+        print(f"Timings written to {path}")
 
 
 # Define a base class for tile engines
@@ -69,6 +149,10 @@ class TileEngine:
     """
 
     TILE_SIZE = 256
+    # A power of 4, so that batches of tiles ordered along the curve cover square areas
+    BATCH_SIZE = 64
+    # Space-filling curve the tiles are scheduled along, "hilbert" or "morton"
+    TILE_ORDER = "hilbert"
 
     def __init__(
         self,
@@ -79,6 +163,19 @@ class TileEngine:
         color_map: ColorMapType | None = None,
         vmin: float = 0,
         vmax: float = 30000,
+        execution: str = "thread",
+        max_workers: int | None = None,
+        pyramid: bool = False,
+        resampling: str = "average",
+        skip_empty: bool = False,
+        deduplicate: str | None = None,
+        output: str = "directory",
+        tile_format: str = "png",
+        tile_options: dict | None = None,
+        resume: bool = False,
+        clip_geometry=None,
+        coverage: bool = False,
+        native_zoom: bool = False,
     ):
         """
         Initialize the TileEngine class.
@@ -91,7 +188,26 @@ class TileEngine:
         color_map (dict or sequence, optional): RGBA Color Table dictionary or sequence.
         vmin (float): The minimum value for rescaling the data.
         vmax (float): The maximum value for rescaling the data.
+        execution (str): Either "thread" or "process".
+        max_workers (int, optional): The number of threads or processes.
+        pyramid (bool): Build the lower zooms from the maximum zoom tiles.
+        resampling (str): The pyramid resampling, either "average" or "mode".
+        skip_empty (bool): Do not write fully transparent tiles.
+        deduplicate (str, optional): Store identical tiles once, either "hardlink" or "manifest".
+        output (str): Either "directory", "mbtiles" or "pmtiles".
+        tile_format (str): The tile encoding, either "png", "webp" or "jpeg".
+        tile_options (dict, optional): Pillow save options of the tile format.
+        resume (bool): Skip the tiles recorded as completed in the manifest.
+        clip_geometry (geopandas.GeoDataFrame or shapely geometry, optional): The geometry the
+            tiles must intersect.
+        coverage (bool): Skip the tiles without data according to a coarse mask of the source.
+        native_zoom (bool): Cap the maximum zoom at the native zoom of the source.
         """
+        if execution not in EXECUTION_MODES:
+            raise ValueError(f"Unsupported execution: {execution}")
+        if resampling not in RESAMPLING_METHODS:
+            raise ValueError(f"Unsupported resampling: {resampling}")
+
         self.data = data
         self.output_folder = output_folder
         self.min_z = min_z
@@ -100,12 +216,424 @@ class TileEngine:
         self.color_map = color_map
         self.vmin = vmin
         self.vmax = vmax
+        # Compiled colormap and range, single band tiles are colored in one lookup
+        self.lut = (
+            ColormapLUT(color_map, vmin, vmax)
+            if ColormapLUT.supports(color_map, vmin, vmax)
+            else None
+        )
+        self.execution = execution
+        self.max_workers = max_workers
+        self.pyramid = pyramid
+        self.resampling = resampling
+        self.readers = None
+        self.timings = TileTimings()
+        self.encoder = TileEncoder(tile_format, tile_options)
+        self.output = output
+        self.writer = get_tile_writer(
+            output, output_folder, skip_empty, deduplicate, self.encoder.extension
+        )
+        self.resume = resume
+        self.completed = set()
+        self.footprint = TileFootprint(clip_geometry) if clip_geometry is not None else None
+        self.coverage = coverage
+        self.coverage_mask = None
+        self.native_zoom = native_zoom
+        self.bbox = None
+
+    def _fingerprint(self) -> str:
+        """
+        Return the fingerprint of the data and of every setting that changes the tiles.
+        """
+        settings = [
+            source_token(self.data),
+            self.color_map,
+            self.vmin,
+            self.vmax,
+            self.TILE_SIZE,
+            self.encoder.tile_format,
+            self.encoder.options,
+            # Tiles completed in another output, or skipped as empty, are not stored here
+            self.output,
+            self.writer.skip_empty,
+            self.writer.deduplicate,
+        ]
+        if self.pyramid:
+            # Every lower zoom is built from the maximum zoom
+            settings += [self.max_z, self.resampling]
+        return fingerprint(*settings)
+
+    def _get_bbox(self):
+        """
+        Return the bounding box of the data in EPSG:4326.
+        """
+        raise NotImplementedError("This method should be implemented by subclasses.")
+
+    def _read_tile(self, tile: mercantile.Tile) -> ImageData:
+        """
+        Read the data of a tile from the source.
+        """
+        raise NotImplementedError("This method should be implemented by subclasses.")
+
+    def _render_tile(self, img: ImageData) -> Image.Image:
+        """
+        Convert the data of a tile to an image.
+
+        Single band data is rescaled from vmin-vmax to 0-255 and colored with the colormap,
+        multi-band data is used as is.
+        """
+        return render_image(img, self.vmin, self.vmax, self.color_map, self.lut)
+
+    def _write_tile(self, tile: mercantile.Tile, image: Image.Image):
+        """
+        Encode the image of a tile and write it, without encoding it if it is skipped as empty.
+        """
+        # Fully transparent tiles are only worth checking if they are skipped
+        empty = self.writer.skip_empty and is_empty(image)
+        payload = b""
+        if not empty:
+            with self.timings.stage(tile.z, "encode"):
+                payload = self.encoder.encode(image)
+        with self.timings.stage(tile.z, "write"):
+            self.writer.write(tile, payload, empty=empty)
+        self.timings.count(tile.z, "written")
+        if not empty:
+            self.timings.count(tile.z, "bytes", len(payload))
+
+    def _skip(self, tile: mercantile.Tile):
+        """
+        Count a tile outside the data bounds.
+        """
+        self.timings.count(tile.z, "skipped")
+
+    def _error(self, tile: mercantile.Tile, e: Exception, errors: list):
+        """
+        Count a tile that failed and record its error.
+        """
+        self.timings.count(tile.z, "errored")
+        errors.append(f"{tile}: {e}")
+
+    def _create_tile(self, tile: mercantile.Tile):
+        """
+        Generate a tile from the source.
+
+        Args:
+            tile (mercantile.Tile): A mercantile tile object.
+        """
+        with self.timings.stage(tile.z, "read"):
+            img = self._read_tile(tile)
+        with self.timings.stage(tile.z, "render"):
+            image = self._render_tile(img)
+        self._write_tile(tile, image)
+
+    def _create_tiles(self, tiles):
+        """
+        Generate a batch of tiles.
+
+        The whole batch is read first and rendered at once, so that single band tiles are colored
+        in a single lookup.
+
+        Returns:
+        tuple: The number of tiles written, the number of tiles outside the data bounds and the
+            list of errors.
+        """
+        written, skipped, errors, imgs = 0, 0, [], {}
+        for tile in tiles:
+            try:
+                with self.timings.stage(tile.z, "read"):
+                    imgs[tile] = self._read_tile(tile)
+            except TileOutsideBounds:
+                self._skip(tile)
+                skipped += 1
+            except Exception as e:
+                self._error(tile, e, errors)
+
+        try:
+            start = time.perf_counter()
+            images = render_images(
+                list(imgs.values()), self.vmin, self.vmax, self.color_map, self.lut
+            )
+            # Batches can mix zooms, the render time is shared evenly between the tiles
+            seconds = (time.perf_counter() - start) / max(len(imgs), 1)
+            for tile in imgs:
+                self.timings.add(tile.z, "render", seconds)
+        except Exception as e:
+            for tile in imgs:
+                self._error(tile, e, errors)
+            return written, skipped, errors
+
+        for tile, image in zip(imgs, images, strict=True):
+            try:
+                self._write_tile(tile, image)
+                written += 1
+            except Exception as e:
+                self._error(tile, e, errors)
+        return written, skipped, errors
+
+    def _get_coverage(self) -> CoverageMask:
+        """
+        Return the coverage mask of the data.
+        """
+        raise NotImplementedError("This method should be implemented by subclasses.")
+
+    def _cap_zoom(self, native_z: int):
+        """
+        Cap the maximum zoom at the native zoom of the source, keeping at least the minimum zoom.
+        """
+        self.max_z = max(self.min_z, min(self.max_z, native_z))
+        self.zooms = list(np.arange(self.min_z, self.max_z + 1))
+        print(f"Native zoom {native_z}, generating zooms {self.min_z} to {self.max_z}")
+
+    def tiles(self, zooms: list) -> list:
+        """
+        Return the tiles of the given zooms that cover the data, within the clipping geometry and
+        with data according to the coverage mask, sorted by zoom and along `TILE_ORDER`.
+        """
+        filters = [f.filter for f in (self.footprint, self.coverage_mask) if f is not None]
+        if filters:
+            tiles = select_tiles(self.bbox, zooms, filters)
+        else:
+            tiles = list(mercantile.tiles(*self.bbox, zooms=zooms))
+        return order_tiles(tiles, self.TILE_ORDER)
+
+    def _intersects(self, tile: mercantile.Tile) -> bool:
+        return intersects_bbox(tile, self.bbox) and all(
+            f.intersects(tile) for f in (self.footprint, self.coverage_mask) if f is not None
+        )
+
+    def _create_parent_tile(self, tile: mercantile.Tile, children: dict):
+        """
+        Generate a tile from the data of its children.
+
+        Returns:
+        numpy.ma.MaskedArray: The tile data, None if every child is empty.
+        """
+        with self.timings.stage(tile.z, "downsample"):
+            mosaic = mosaic_children(tile, children, self.TILE_SIZE)
+            if mosaic is None:
+                return None
+            data = downsample(mosaic, self.resampling)
+        # Rendering rescales in place, keep the data untouched for the parent tile
+        with self.timings.stage(tile.z, "render"):
+            image = self._render_tile(ImageData(data.copy()))
+        self._write_tile(tile, image)
+        return data
+
+    def _read_completed(self, tile: mercantile.Tile) -> np.ma.MaskedArray | None:
+        """
+        Rebuild the data of a completed tile, to build its parent, without writing anything.
+
+        As when the tile was written, only its descendants at the maximum zoom are read from the
+        source, then mosaicked and downsampled, so that resumed runs build the same parents as
+        a single run.
+        """
+        if tile.z == self.max_z:
+            try:
+                with self.timings.stage(tile.z, "read"):
+                    return self._read_tile(tile).array
+            except TileOutsideBounds:
+                return None
+
+        children = {
+            child: self._read_completed(child)
+            for child in mercantile.children(tile)
+            if self._intersects(child)
+        }
+        with self.timings.stage(tile.z, "downsample"):
+            mosaic = mosaic_children(tile, children, self.TILE_SIZE)
+            return None if mosaic is None else downsample(mosaic, self.resampling)
+
+    def _create_pyramid(self, tile: mercantile.Tile, errors: list):
+        """
+        Generate a tile and all its descendants down to the maximum zoom, bottom-up.
+
+        Only the maximum zoom is read from the source, every other tile is built by mosaicking
+        and downsampling the data of its four children, one branch at a time.
+
+        Returns:
+        tuple: The number of tiles written, the number of tiles outside the data bounds and the
+            tile data (None if the tile is empty).
+        """
+        if tile in self.completed:
+            # Parents are written after their children, so the whole branch is complete too
+            try:
+                return 0, 0, self._read_completed(tile)
+            except Exception as e:
+                self._error(tile, e, errors)
+                return 0, 0, None
+
+        if tile.z == self.max_z:
+            try:
+                with self.timings.stage(tile.z, "read"):
+                    data = self._read_tile(tile).array
+                with self.timings.stage(tile.z, "render"):
+                    image = self._render_tile(ImageData(data.copy()))
+                self._write_tile(tile, image)
+                return 1, 0, data
+            except TileOutsideBounds:
+                self._skip(tile)
+                return 0, 1, None
+            except Exception as e:
+                self._error(tile, e, errors)
+                return 0, 0, None
+
+        written, skipped, children = 0, 0, {}
+        for child in mercantile.children(tile):
+            if self._intersects(child):
+                child_written, child_skipped, children[child] = self._create_pyramid(child, errors)
+                written += child_written
+                skipped += child_skipped
+        try:
+            data = self._create_parent_tile(tile, children)
+        except Exception as e:
+            self._error(tile, e, errors)
+            data = None
+        return written + (data is not None), skipped, data
+
+    def _create_pyramids(self, tiles):
+        """
+        Generate a batch of pyramids.
+
+        Returns:
+        tuple: The number of tiles written, the number of tiles outside the data bounds, the
+            list of errors and the data of the root tiles.
+        """
+        written, skipped, errors, datas = 0, 0, [], {}
+        for tile in tiles:
+            tile_written, tile_skipped, datas[tile] = self._create_pyramid(tile, errors)
+            written += tile_written
+            skipped += tile_skipped
+        return written, skipped, errors, datas
+
+    def _run(self, tiles, method="_create_tiles", batch_size=None):
+        """
+        Generate the tiles with the configured execution mode.
+        """
+        results = run_tile_jobs(
+            self,
+            tiles,
+            self.execution,
+            self.max_workers,
+            batch_size or self.BATCH_SIZE,
+            method=method,
+        )
+        for error in (error for result in results for error in result[2]):
+            print(f"An error occurred while generating tiles: {error}")
+        return results
+
+    def _generate_pyramid(self):
+        """
+        Generate the tiles bottom-up from the maximum zoom.
+
+        The pyramids are split at the first zoom with enough tiles to keep every worker busy,
+        the zooms above it are then built from the root tiles of those pyramids.
+        """
+        workers = self.max_workers or os.cpu_count() or 1
+        split_z = next(
+            (z for z in self.zooms if len(self.tiles([z])) >= 4 * workers),
+            self.max_z,
+        )
+        roots = self.tiles([split_z])
+        upper = self.tiles(list(range(self.min_z, split_z)))
+        if all(tile in self.completed for tile in upper):
+            # The data of the roots is only needed to build the zooms above them
+            roots = [tile for tile in roots if tile not in self.completed]
+
+        datas = {}
+        for result in self._run(roots, method="_create_pyramids", batch_size=1):
+            datas.update(result[3])
+
+        errors = []
+        for z in range(split_z - 1, self.min_z - 1, -1):
+            parents = {}
+            for tile in self.tiles([z]):
+                try:
+                    if tile in self.completed:
+                        if z > self.min_z and mercantile.parent(tile) not in self.completed:
+                            parents[tile] = self._read_completed(tile)
+                        continue
+                    children = {child: datas.get(child) for child in mercantile.children(tile)}
+                    parents[tile] = self._create_parent_tile(tile, children)
+                except Exception as e:
+                    self._error(tile, e, errors)
+            datas = parents
+        for error in errors:
+            print(f"An error occurred while generating tiles: {error}")
+
+    def prepare(self):
+        """
+        Compute the bounding box of the data and, if enabled, its native zoom and coverage mask.
+        """
+        # Get the bounding box
+        self.bbox = self._get_bbox()
+        if self.native_zoom:
+            self._cap_zoom(native_zoom(self.data))
+        if self.coverage:
+            self.coverage_mask = self._get_coverage()
+
+    def render_tile(self, tile: mercantile.Tile) -> bytes | None:
+        """
+        Read, render and encode a single tile on demand, without writing it.
+
+        The engine must be prepared first.
+
+        Args:
+            tile (mercantile.Tile): A mercantile tile object.
+
+        Returns:
+        bytes: The encoded tile. None if the tile has no data, or is empty and empty tiles are
+            skipped.
+        """
+        if not self._intersects(tile):
+            return None
+        try:
+            with self.timings.stage(tile.z, "read"):
+                img = self._read_tile(tile)
+        except TileOutsideBounds:
+            self._skip(tile)
+            return None
+        with self.timings.stage(tile.z, "render"):
+            image = self._render_tile(img)
+        if self.writer.skip_empty and is_empty(image):
+            return None
+        with self.timings.stage(tile.z, "encode"):
+            payload = self.encoder.encode(image)
+        self.timings.count(tile.z, "written")
+        self.timings.count(tile.z, "bytes", len(payload))
+        return payload
 
     def generate_tiles(self):
         """
         Generate tiles from the data.
         """
-        raise NotImplementedError("This method should be implemented by subclasses.")
+        self.prepare()
+
+        manifest = None
+        if self.resume:
+            manifest = TileManifest(Path(self.output_folder) / MANIFEST_FILE, self._fingerprint())
+            self.completed = manifest.completed()
+            self.writer.manifest = manifest
+
+        try:
+            if self.pyramid:
+                self._generate_pyramid()
+            else:
+                # Calculate the tiles within the bounding box at the given zoom level
+                tiles = self.tiles(self.zooms)
+                tiles = [tile for tile in tiles if tile not in self.completed]
+
+                # Parallelize the process
+                self._run(tiles)
+        finally:
+            # Completed pyramid tiles are read back on this thread
+            if self.readers is not None:
+                self.readers.close()
+
+        self.writer.close()
+        if manifest is not None:
+            manifest.close()
+        for line in self.writer.report():
+            print(line)
 
 
 # Define a class for the rasterio engine
@@ -123,64 +651,12 @@ class RasterioEngine(TileEngine):
             raise ValueError(
                 "For engine 'rasterio', 'data' must be a valid directory or file path."
             )
+        # One open reader per worker thread, reused for the whole run
+        self.readers = ThreadLocalReaders()
 
-    def _create_tile(
-        self,
-        tile: mercantile.Tile = None,
-        tif_file_path: str = None,
-        num_bands: int = 4,
-        indexes: tuple[int] | None = (1, 2, 3, 4),
-        colormap: ColorMapType | None = None,
-    ):
-        """
-        Generate a PNG tiles from a GeoTIFF file using rio-tiler.
-
-        Args:
-            tile (mercantile.Tile): A mercantile tile object.
-            tif_file_path (str): The file path to the GeoTIFF file.
-            num_bands (int): The number of bands in the GeoTIFF file.
-            indexes (int or sequence of int, optional): Band indexes.
-            colormap (dict or sequence, optional): RGBA Color Table dictionary or sequence.
-            vmin (float): The minimum value for rescaling the data.
-            vmax (float): The maximum value for rescaling the data.
-        """
-        try:
-            with Reader(tif_file_path) as dst:
-                # Get the tile data and mask
-                img = dst.tile(tile.x, tile.y, tile.z, indexes=indexes, tilesize=self.TILE_SIZE)
-                # Convert the data to an image
-                if num_bands == 1:
-                    # Rescale the data linearly from 0-10000 to 0-255
-                    img.rescale(in_range=((self.vmin, self.vmax),), out_range=((0, 255),))
-                    # Apply colormap and create a PNG buffer
-                    buff = img.render(colormap=colormap, add_mask=True)
-                    # Open the image from the buffer
-                    image = Image.open(io.BytesIO(buff))
-                else:
-                    image = Image.fromarray(np.uint8(np.transpose(img.data, (1, 2, 0))))
-
-                # Save the image as a PNG
-                tile_dir = os.path.join(self.output_folder, str(tile.z), str(tile.x))
-                tile_file = os.path.join(tile_dir, f"{tile.y}.png")
-                os.makedirs(tile_dir, exist_ok=True)
-                image.save(tile_file, "PNG")
-        except TileOutsideBounds:
-            pass
-        except Exception as e:
-            print(f"An error occurred while generating tiles: {e}")
-
-    def _create_tile_wrapper(self, tile):
-        self._create_tile(
-            tile,
-            tif_file_path=self.data,
-            num_bands=self.num_bands,
-            indexes=self.indexes,
-            colormap=self.color_map,
-        )
-
-    def generate_tiles(self):
+    def _get_bbox(self):
         """
-        Generate tiles from a GeoTIFF files.
+        Return the bounding box of the GeoTIFF file and set the band indexes to read.
         """
         # Open the GeoTIFF file
         with rasterio.open(self.data) as src:
@@ -189,15 +665,24 @@ class RasterioEngine(TileEngine):
             # Get the count of bands
             self.num_bands = src.count
 
-        # Calculate the tiles within the bounding box at the given zoom level
-        tiles = list(mercantile.tiles(bbox[0], bbox[1], bbox[2], bbox[3], zooms=self.zooms))
-
         # Set the indexes parameter based on the number of bands
         self.indexes = (1, 2, 3, 4) if self.num_bands == 4 else None
+        return bbox
+
+    def _get_coverage(self) -> CoverageMask:
+        """
+        Return the coverage mask of the GeoTIFF file, from its dataset mask.
+        """
+        return CoverageMask.from_raster(self.data)
 
-        # Using ThreadPoolExecutor to parallelize the process
-        with ThreadPoolExecutor() as executor:
-            executor.map(self._create_tile_wrapper, tiles)
+    def _read_tile(self, tile: mercantile.Tile) -> ImageData:
+        """
+        Read the data of a tile from the GeoTIFF file using rio-tiler.
+        """
+        # Reuse the reader opened by this worker thread
+        dst = self.readers.get(self.data)
+        # Get the tile data and mask
+        return dst.tile(tile.x, tile.y, tile.z, indexes=self.indexes, tilesize=self.TILE_SIZE)
 
 
 # Define a class for the xarray engine
@@ -214,62 +699,22 @@ class XArrayEngine(TileEngine):
         if not isinstance(self.data, xr.DataArray):
             raise ValueError("For engine 'xarray', 'data' must be an xarray.DataArray.")
 
-    def _create_tile(
-        self,
-        tile: mercantile.Tile = None,
-        da: xr.DataArray = None,
-        colormap: ColorMapType | None = None,
-    ):
+    def _get_bbox(self):
         """
-        Generate a PNG tile from a xarray DataArray using rio-tiler.
-
-        Args:
-            tile (mercantile.Tile): A mercantile tile object.
-            num_bands (int): The number of bands in the GeoTIFF file.
-            indexes (int or sequence of int, optional): Band indexes.
-            colormap (dict or sequence, optional): RGBA Color Table dictionary or sequence.
-            vmin (float): The minimum value for rescaling the data.
-            vmax (float): The maximum value for rescaling the data.
+        Return the bounding box of the xarray array.
         """
-        try:
-            with XarrayReader(da) as dst:
-                # Get the tile data and mask
-                img = dst.tile(tile.x, tile.y, tile.z, tilesize=self.TILE_SIZE)
-                # Convert the data to an image
-                # Rescale the data linearly from 0-10000 to 0-255
-                img.rescale(in_range=((self.vmin, self.vmax),), out_range=((0, 255),))
-                # Apply colormap and create a PNG buffer
-                buff = img.render(colormap=colormap, add_mask=True)
-                # Open the image from the buffer
-                image = Image.open(io.BytesIO(buff))
-
-                # Save the image as a PNG
-                tile_dir = os.path.join(self.output_folder, str(tile.z), str(tile.x))
-                tile_file = os.path.join(tile_dir, f"{tile.y}.png")
-                os.makedirs(tile_dir, exist_ok=True)
-                image.save(tile_file, "PNG")
-        except TileOutsideBounds:
-            pass
-        except Exception as e:
-            print(f"An error occurred while generating tiles: {e}")
+        return list(self.data.rio.bounds())
 
-    def _create_tile_wrapper(self, tile):
-        self._create_tile(
-            tile,
-            da=self.data,
-            colormap=self.color_map,
-        )
-
-    def generate_tiles(self):
+    def _get_coverage(self) -> CoverageMask:
         """
-        Generate tiles from a xarray array.
+        Return the coverage mask of the xarray array.
         """
-        # Get the bounding box
-        bbox = list(self.data.rio.bounds())
+        return CoverageMask.from_dataarray(self.data)
 
-        # Calculate the tiles within the bounding box at the given zoom level
-        tiles = list(mercantile.tiles(bbox[0], bbox[1], bbox[2], bbox[3], zooms=self.zooms))
-
-        # Using ThreadPoolExecutor to parallelize the process
-        with ThreadPoolExecutor() as executor:
-            executor.map(self._create_tile_wrapper, tiles)
+    def _read_tile(self, tile: mercantile.Tile) -> ImageData:
+        """
+        Read the data of a tile from the xarray DataArray using rio-tiler.
+        """
+        with XarrayReader(self.data) as dst:
+            # Get the tile data and mask
+            return dst.tile(tile.x, tile.y, tile.z, tilesize=self.TILE_SIZE)
@@ -2,12 +2,16 @@
 Module to upload data to s3 bucket.
 """
 
+import json
 import os
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
 from botocore.config import Config
 from dotenv import load_dotenv
+from helpers.tile_manifest import MANIFEST_FILE
+from helpers.tile_timings import TIMINGS_FILE
+from helpers.tile_writers import DUPLICATES_MANIFEST
 from tqdm import tqdm
 
 # Load environment variables from the .env file
@@ -26,6 +30,10 @@ def upload_files_to_s3_parallel(
     """
     Upload all files in a folder to an S3 bucket using parallel uploads.
 
+    Tiles listed in a `duplicates.json` manifest (see `DirectoryTileWriter`) are not on disk,
+    they are created with server-side copies of the uploaded tile they duplicate. The
+    `manifest.sqlite` of resumable runs and the `timings.json` report are not uploaded.
+
     Parameters:
     folder_path (str): The local folder path to upload.
     destination_blob_path (str): The destination path in the S3 bucket.
@@ -62,6 +70,25 @@ def upload_files_to_s3_parallel(
         except FileNotFoundError as e:
             print(f"Error uploading {file_path}: {e}")
 
+    def copy_file(key, original_key):
+        """
+        Copy an uploaded file to another key of the bucket, without uploading it again.
+        """
+        s3_client.copy_object(
+            Bucket=AWS_BUCKET_NAME,
+            Key=os.path.join(destination_blob_path, key),
+            CopySource={
+                "Bucket": AWS_BUCKET_NAME,
+                "Key": os.path.join(destination_blob_path, original_key),
+            },
+        )
+
+    manifest_path = os.path.join(folder_path, DUPLICATES_MANIFEST)
+    duplicates = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as f:
+            duplicates = json.load(f)
+
     # Use ThreadPoolExecutor to upload files in parallel
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         futures = []
@@ -69,9 +96,21 @@ def upload_files_to_s3_parallel(
         for root, _, files in os.walk(folder_path):
             for file_name in files:
                 file_path = os.path.join(root, file_name)
+                # Files of the run itself, not tiles
+                run_file = file_name.startswith(MANIFEST_FILE) or file_name == TIMINGS_FILE
+                if file_path == manifest_path or run_file:
+                    continue
                 futures.append(executor.submit(upload_file, file_path))
 
         # Wait for all uploads to complete
         for future in tqdm(as_completed(futures), total=len(futures)):
             # for future in as_completed(futures):
             future.result()
+
+        # Copy the duplicated tiles once their originals are uploaded
+        futures = [
+            executor.submit(copy_file, key, original_key)
+            for key, original_key in duplicates.items()
+        ]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result()
@@ -0,0 +1,239 @@
+"""
+Module for rendering tile data to images and encoding them
+"""
+
+import io
+
+import numpy as np
+from PIL import Image
+from rio_tiler.colormap import ColorMapType, apply_cmap, make_lut
+from rio_tiler.models import ImageData
+
+# Tile formats and the extension of their files
+TILE_FORMATS = {"png": "png", "webp": "webp", "jpeg": "jpg"}
+# Default Pillow options of every format, overridden by the encoder options
+DEFAULT_OPTIONS = {
+    "png": {"compress_level": 6},
+    "webp": {"quality": 80, "method": 4},
+    "jpeg": {"quality": 90},
+}
+
+
+class ColormapLUT:
+    """
+    Rescales and colors single band data in one lookup, with the colormap and the vmin-vmax range
+    compiled into a table once.
+
+    The table has the 256 colors of the colormap and a last, transparent, entry for the nodata
+    pixels. Integer data of up to 16 bits is looked up directly in a table of every possible
+    value, other data is first rescaled to an index with in-place operations. The colors are
+    the same as rio-tiler's rescale and render.
+
+    Attributes:
+    colormap (dict, optional): GDAL RGBA Color Table dictionary of 256 entries, grayscale if None.
+    vmin (float): The minimum value for rescaling the data.
+    vmax (float): The maximum value for rescaling the data.
+    """
+
+    def __init__(self, colormap: dict | None, vmin: float, vmax: float):
+        """
+        Initializes the ColormapLUT class.
+        """
+        if colormap:
+            lut = make_lut(colormap)
+        else:
+            # Grayscale, opaque where there is data
+            lut = np.full((256, 4), 255, dtype=np.uint8)
+            lut[:, :3] = np.arange(256, dtype=np.uint8)[:, None]
+        # Nodata pixels are rescaled to 0 and made transparent
+        nodata = np.append(lut[0, :3], 0).astype(np.uint8)
+        self.colormap = colormap
+        self.vmin = vmin
+        self.vmax = vmax
+        self.lut = np.vstack([lut, nodata])
+        self._tables = {}
+
+    @staticmethod
+    def supports(colormap: ColorMapType | None, vmin: float, vmax: float) -> bool:
+        """
+        Return whether a colormap and range can be compiled, interval colormaps and colormaps
+        with other than 256 entries are not.
+        """
+        if vmin is None or vmax is None:
+            return False
+        if not colormap:
+            return True
+        return (
+            isinstance(colormap, dict)
+            and len(colormap) == 256
+            and all(isinstance(k, int | np.integer) and 0 <= k < 256 for k in colormap)
+        )
+
+    def _index(self, data: np.ndarray) -> np.ndarray:
+        """
+        Rescale data from vmin-vmax to a 0-255 colormap index, as rio-tiler does.
+        """
+        index = np.clip(data, self.vmin, self.vmax, dtype=np.float64)
+        index -= self.vmin
+        index /= np.float64(self.vmax - self.vmin)
+        index *= 255
+        # rio-tiler stores the rescaled values in the data type before casting them to uint8
+        return index.astype(data.dtype).astype(np.uint8)
+
+    def _table(self, dtype: np.dtype) -> tuple:
+        """
+        Return the colors of every value of a small integer type, and its offset.
+        """
+        if dtype not in self._tables:
+            info = np.iinfo(dtype)
+            values = np.arange(info.min, info.max + 1).astype(dtype)
+            self._tables[dtype] = (
+                np.vstack([self.lut[self._index(values)], self.lut[-1:]]),
+                info.min,
+            )
+        return self._tables[dtype]
+
+    def colorize(self, data: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        """
+        Return the RGBA colors of the data.
+
+        Args:
+            data (numpy.ndarray): The data, of any shape, e.g. a batch of tiles (tiles, rows, cols).
+            valid (numpy.ndarray): Whether every pixel has data, of the same shape.
+
+        Returns:
+        numpy.ndarray: The uint8 colors, of the shape of the data plus a last axis of 4 bands.
+        """
+        if data.dtype.kind in "iu" and data.dtype.itemsize <= 2:
+            table, offset = self._table(data.dtype)
+            index = data.astype(np.int32)
+            if offset:
+                index -= offset
+        else:
+            table, index = self.lut, self._index(data)
+        index = np.where(valid, index, np.int32(len(table) - 1))
+        # Look up whole RGBA pixels at once, as 32-bit values
+        colors = np.take(table.view(np.uint32)[:, 0], index)
+        return colors.view(np.uint8).reshape(*index.shape, 4)
+
+    def render(self, imgs: list) -> list:
+        """
+        Color a batch of single band tiles of the same size at once.
+
+        Args:
+            imgs (list): The rio-tiler ImageData of the tiles.
+
+        Returns:
+        list: The PIL images.
+        """
+        data = np.stack([img.array.data[0] for img in imgs])
+        valid = ~np.stack([np.ma.getmaskarray(img.array)[0] for img in imgs])
+        return [Image.fromarray(rgba, "RGBA") for rgba in self.colorize(data, valid)]
+
+
+def render_image(
+    img: ImageData,
+    vmin: float,
+    vmax: float,
+    colormap: ColorMapType | None = None,
+    lut: ColormapLUT | None = None,
+) -> Image.Image:
+    """
+    Convert the data of a tile to an image, without encoding it.
+
+    Single band data is rescaled from vmin-vmax to 0-255 and colored with the colormap, with the
+    nodata pixels transparent, multi-band data is used as is.
+
+    Args:
+        img (rio_tiler.models.ImageData): The tile data. Single band data is rescaled in place,
+            unless it is colored with the lookup table.
+        vmin (float): The minimum value for rescaling the data.
+        vmax (float): The maximum value for rescaling the data.
+        colormap (dict or sequence, optional): RGBA Color Table dictionary or sequence.
+        lut (ColormapLUT, optional): The compiled colormap and range, if supported.
+    """
+    return render_images([img], vmin, vmax, colormap, lut)[0]
+
+
+def render_images(
+    imgs: list,
+    vmin: float,
+    vmax: float,
+    colormap: ColorMapType | None = None,
+    lut: ColormapLUT | None = None,
+) -> list:
+    """
+    Convert the data of a batch of tiles to images, the single band tiles of the same size are
+    colored at once with the lookup table, if any.
+
+    Args:
+        imgs (list): The rio-tiler ImageData of the tiles.
+        vmin (float): The minimum value for rescaling the data.
+        vmax (float): The maximum value for rescaling the data.
+        colormap (dict or sequence, optional): RGBA Color Table dictionary or sequence.
+        lut (ColormapLUT, optional): The compiled colormap and range, if supported.
+    """
+    images = [None] * len(imgs)
+    batch = [
+        i
+        for i, img in enumerate(imgs)
+        if lut is not None and img.count == 1 and img.alpha_mask is None
+    ]
+    shapes = {imgs[i].array.shape for i in batch}
+    for shape in shapes:
+        same = [i for i in batch if imgs[i].array.shape == shape]
+        for i, image in zip(same, lut.render([imgs[i] for i in same]), strict=True):
+            images[i] = image
+
+    for i, img in enumerate(imgs):
+        if images[i] is not None:
+            continue
+        if img.count != 1:
+            images[i] = Image.fromarray(np.uint8(np.transpose(img.data, (1, 2, 0))))
+            continue
+        img.rescale(in_range=((vmin, vmax),), out_range=((0, 255),))
+        mask = img.mask
+        if colormap:
+            rgb, alpha = apply_cmap(img.data, colormap)
+            # Same as rio-tiler render: the colormap alpha where there is data
+            alpha = np.where(mask != 0, alpha, 0)
+        else:
+            rgb, alpha = np.repeat(img.data, 3, axis=0), mask
+        images[i] = Image.fromarray(np.dstack([*rgb, alpha]).astype(np.uint8), "RGBA")
+    return images
+
+
+class TileEncoder:
+    """
+    Encodes tile images in a single pass.
+
+    Attributes:
+    tile_format (str, optional): "png", "webp" or "jpeg". JPEG has no transparency and is meant
+        for opaque layers. Defaults to "png".
+    options (dict, optional): Pillow save options, e.g. `{"compress_level": 9}` for PNG,
+        `{"lossless": True}` or `{"quality": 75}` for WebP. Defaults to None.
+    """
+
+    def __init__(self, tile_format: str = "png", options: dict | None = None):
+        """
+        Initializes the TileEncoder class.
+        """
+        if tile_format not in TILE_FORMATS:
+            raise ValueError(f"Unsupported tile format: {tile_format}")
+
+        self.tile_format = tile_format
+        self.extension = TILE_FORMATS[tile_format]
+        self.options = {**DEFAULT_OPTIONS[tile_format], **(options or {})}
+
+    def encode(self, image: Image.Image) -> bytes:
+        """
+        Encode an image.
+
+        Args:
+            image (PIL.Image.Image): The tile image.
+        """
+        if self.tile_format == "jpeg" and image.mode != "RGB":
+            image = image.convert("RGB")
+        buff = io.BytesIO()
+        image.save(buff, self.tile_format.upper(), **self.options)
+        return buff.getvalue()
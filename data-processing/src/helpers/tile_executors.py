@@ -0,0 +1,140 @@
+"""
+Module for running tile jobs in thread or process pools
+"""
+
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import islice
+from multiprocessing.util import Finalize
+
+from helpers.tile_readers import map_with_readers
+from helpers.tile_writers import BufferedTileWriter
+
+EXECUTION_MODES = ("thread", "process")
+
+# Engine of the current process pool worker, set once by the pool initializer
+_worker_engine = None
+
+
+def batched(items, batch_size: int):
+    """
+    Split an iterable into lists of at most `batch_size` items.
+
+    Args:
+        items (iterable): The items to split.
+        batch_size (int): The maximum number of items per batch.
+    """
+    items = iter(items)
+    while batch := list(islice(items, batch_size)):
+        yield batch
+
+
+def _init_worker(engine):
+    """
+    Store the engine of a process pool worker, closing its readers and manifest when it exits.
+
+    Writers that must see every tile (e.g. to deduplicate them) are replaced by a buffer whose
+    tiles are sent back to the parent process.
+    """
+    global _worker_engine
+    _worker_engine = engine
+    if engine.readers is not None:
+        Finalize(engine, engine.readers.close, exitpriority=10)
+    if engine.writer is not None and not engine.writer.process_safe:
+        engine.writer = BufferedTileWriter(engine.writer.skip_empty)
+    elif engine.writer is not None and engine.writer.manifest is not None:
+        # Worker writers record their tiles in the manifest themselves
+        Finalize(engine, engine.writer.manifest.close, exitpriority=10)
+
+
+def _run_batch(method, batch):
+    result = getattr(_worker_engine, method)(batch)
+    writer, timings = _worker_engine.writer, _worker_engine.timings
+    return (
+        result,
+        writer.drain() if writer is not None else None,
+        timings.drain() if timings is not None else None,
+    )
+
+
+def _run_in_processes(engine, jobs, max_workers, batch_size, method, done):
+    max_workers = max_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_worker,
+        initargs=(engine,),
+    ) as executor:
+        # Keep a bounded number of batches in flight so that returned tiles are written as they
+        # arrive instead of piling up in memory
+        batches = batched(jobs, batch_size)
+        pending = set()
+        while True:
+            for batch in batches:
+                pending.add(executor.submit(_run_batch, method, batch))
+                if len(pending) >= 2 * max_workers:
+                    break
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                result, drained, timings = future.result()
+                if drained is not None:
+                    engine.writer.merge(*drained)
+                if timings is not None:
+                    engine.timings.merge(timings)
+                done(result)
+
+
+def run_tile_jobs(
+    engine,
+    jobs,
+    execution: str = "thread",
+    max_workers: int | None = None,
+    batch_size: int = 64,
+    method: str = "_create_tiles",
+    progress=None,
+):
+    """
+    Run the tile jobs of an engine in batches across a thread or a process pool.
+
+    In "thread" mode the batches share the engine and its per-thread readers, which suits I/O
+    bound sources. In "process" mode the engine is sent once to every worker process, which
+    opens its own source handles, and only counts, timings and errors are sent back (plus the
+    encoded tiles when the writer is not process safe). That avoids the GIL for the CPU-bound
+    rescale, colormap and encode steps.
+
+    Args:
+        engine (TileEngine): The engine running the jobs.
+        jobs (iterable): The tile jobs.
+        execution (str, optional): Either "thread" or "process". Defaults to "thread".
+        max_workers (int, optional): The number of workers. Defaults to the executor default.
+        batch_size (int, optional): The number of jobs per batch. Defaults to 64.
+        method (str, optional): The engine method called with every batch. Defaults to
+            "_create_tiles".
+        progress (callable, optional): Called with the value returned for every batch, as the
+            batches complete. Defaults to None.
+
+    Returns:
+    list: The value returned by the engine method for every batch, in completion order.
+    """
+    if execution not in EXECUTION_MODES:
+        raise ValueError(f"Unsupported execution: {execution}")
+
+    results = []
+
+    def done(result):
+        results.append(result)
+        if progress is not None:
+            progress(result)
+
+    if execution == "thread":
+        map_with_readers(
+            lambda batch: done(getattr(engine, method)(batch)),
+            batched(jobs, batch_size),
+            engine.readers,
+            max_workers,
+        )
+    else:
+        _run_in_processes(engine, jobs, max_workers, batch_size, method, done)
+
+    return results
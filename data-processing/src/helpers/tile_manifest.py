@@ -0,0 +1,148 @@
+"""
+Module for recording the tiles completed by a run so that later runs can resume
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import mercantile
+import xarray as xr
+
+MANIFEST_FILE = "manifest.sqlite"
+
+
+def source_token(data) -> str:
+    """
+    Return a token that changes whenever the source data changes.
+
+    Files are identified by their path, size and modification time, directories by those of
+    their files, and DataArrays by the dask token of their data and coordinates.
+
+    Args:
+        data (str, Path or xarray.DataArray): The source data.
+    """
+    if isinstance(data, xr.DataArray):
+        from dask.base import tokenize
+
+        return tokenize(data)
+
+    path = Path(data).resolve()
+    files = sorted(path.rglob("*")) if path.is_dir() else [path]
+    stats = [(str(f), f.stat().st_size, f.stat().st_mtime_ns) for f in files if f.is_file()]
+    return repr((str(path), stats))
+
+
+def fingerprint(*parts) -> str:
+    """
+    Return a short hash of everything a tile depends on.
+
+    Args:
+        *parts: The settings of the tiles, with a stable `repr`.
+    """
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+
+class TileManifest:
+    """
+    Records, in a SQLite file, the tiles completed with a given fingerprint.
+
+    Tiles are recorded by the writer once they are stored, in small transactions. A crash only
+    loses the records still pending, so those tiles are generated again but never skipped while
+    missing. The file can be shared by several processes.
+
+    Attributes:
+    path (str): The path of the SQLite file.
+    fingerprint (str): The fingerprint of the source data and the rendering settings.
+    """
+
+    FLUSH_SIZE = 256
+
+    def __init__(self, path: Path, fingerprint: str):
+        """
+        Initializes the TileManifest class.
+        """
+        self.path = str(path)
+        self.fingerprint = fingerprint
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pending = []
+
+    def __getstate__(self):
+        """
+        Pickle the manifest settings, worker processes open their own connection.
+        """
+        return {"path": self.path, "fingerprint": self.fingerprint}
+
+    def __setstate__(self, state):
+        """
+        Restore the manifest with no connection and nothing pending.
+        """
+        self.__init__(state["path"], state["fingerprint"])
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS tiles (
+                    z INTEGER, x INTEGER, y INTEGER, fingerprint TEXT,
+                    PRIMARY KEY (z, x, y)
+                )
+                """
+            )
+        return self._conn
+
+    def completed(self) -> set:
+        """
+        Return the tiles already completed with the current fingerprint.
+        """
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT x, y, z FROM tiles WHERE fingerprint = ?", (self.fingerprint,)
+            )
+            return {mercantile.Tile(*row) for row in rows}
+
+    def add(self, tiles: list):
+        """
+        Record completed tiles, written to the file in batches.
+
+        Args:
+            tiles (list): The mercantile tiles that are stored.
+        """
+        with self._lock:
+            self._pending.extend(tiles)
+            if len(self._pending) >= self.FLUSH_SIZE:
+                self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                [(int(t.z), int(t.x), int(t.y), self.fingerprint) for t in self._pending],
+            )
+        self._pending = []
+
+    def flush(self):
+        """
+        Write the pending records.
+        """
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        """
+        Write the pending records and close the file.
+        """
+        with self._lock:
+            self._flush()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,80 @@
+"""
+Module for building parent tiles from the data of their children
+"""
+
+import mercantile
+import numpy as np
+
+RESAMPLING_METHODS = ("average", "mode")
+
+
+def mosaic_children(
+    tile: mercantile.Tile, children: dict, tilesize: int
+) -> np.ma.MaskedArray | None:
+    """
+    Mosaic the data of the four children of a tile into a single array of twice the tile size.
+
+    Args:
+        tile (mercantile.Tile): The parent tile.
+        children (dict): The masked arrays (bands, rows, cols) of the children tiles, keyed by
+            tile. Missing or empty children can be left out or set to None.
+        tilesize (int): The size of the tiles in pixels.
+
+    Returns:
+    numpy.ma.MaskedArray: The mosaic, masked where there is no child data. None if every child
+        is empty.
+    """
+    arrays = [array for array in children.values() if array is not None]
+    if not arrays:
+        return None
+
+    count, dtype = arrays[0].shape[0], arrays[0].dtype
+    mosaic = np.ma.masked_array(
+        np.zeros((count, 2 * tilesize, 2 * tilesize), dtype=dtype), mask=True
+    )
+    for child, array in children.items():
+        if array is None:
+            continue
+        row = (child.y - 2 * tile.y) * tilesize
+        col = (child.x - 2 * tile.x) * tilesize
+        mosaic[:, row : row + tilesize, col : col + tilesize] = array
+    return mosaic
+
+
+def downsample(array: np.ma.MaskedArray, resampling: str = "average") -> np.ma.MaskedArray:
+    """
+    Downsample a masked array (bands, rows, cols) by a factor of two.
+
+    Args:
+        array (numpy.ma.MaskedArray): The array to downsample. Rows and cols must be even.
+        resampling (str, optional): "average" for continuous data, it averages the valid pixels
+            of every 2x2 block, or "mode" for categorical data, it keeps the most frequent valid
+            pixel (all bands compared together). Defaults to "average".
+    """
+    if resampling not in RESAMPLING_METHODS:
+        raise ValueError(f"Unsupported resampling: {resampling}")
+
+    count, rows, cols = array.shape
+    data = np.ma.getdata(array).reshape(count, rows // 2, 2, cols // 2, 2)
+    mask = np.ma.getmaskarray(array).reshape(count, rows // 2, 2, cols // 2, 2)
+
+    if resampling == "average":
+        valid = ~mask
+        total = np.where(valid, data, 0).sum(axis=(2, 4), dtype=np.float64)
+        n = valid.sum(axis=(2, 4))
+        result = np.divide(total, n, out=np.zeros_like(total), where=n > 0)
+        if np.issubdtype(array.dtype, np.integer):
+            result = np.rint(result)
+        return np.ma.masked_array(result.astype(array.dtype), mask=n == 0)
+
+    # Candidates of every output pixel: (rows, cols, 4, bands)
+    candidates = data.transpose(1, 3, 2, 4, 0).reshape(rows // 2, cols // 2, 4, count)
+    invalid = mask.transpose(1, 3, 2, 4, 0).reshape(rows // 2, cols // 2, 4, count).all(-1)
+    # Count, for every candidate, how many valid candidates share its value (ties keep the first)
+    equal = (candidates[:, :, :, None, :] == candidates[:, :, None, :, :]).all(-1)
+    votes = (equal & ~invalid[:, :, None, :]).sum(-1)
+    votes[invalid] = -1
+    best = votes.argmax(-1)[:, :, None, None]
+    result = np.take_along_axis(candidates, best, axis=2)[:, :, 0, :].transpose(2, 0, 1)
+    empty = np.broadcast_to(invalid.all(-1), result.shape)
+    return np.ma.masked_array(np.where(empty, 0, result), mask=empty)
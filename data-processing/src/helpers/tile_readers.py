@@ -0,0 +1,253 @@
+"""
+Module for sharing open raster readers across tiles
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+import mercantile
+import numpy as np
+import xarray as xr
+from rio_tiler.constants import WEB_MERCATOR_CRS
+from rio_tiler.errors import TileOutsideBounds
+from rio_tiler.io import Reader, XarrayReader
+from rio_tiler.models import ImageData
+
+
+class ThreadLocalReaders:
+    """
+    Keeps one open reader per worker thread and per file.
+
+    rasterio dataset handles (and the GDAL environment they open) belong to the thread that
+    created them, so every thread gets its own readers and must close them itself. Readers are
+    opened lazily the first time a thread asks for a file and kept open until that thread calls
+    `close`, so file headers, overviews and GDAL block caches are reused across tiles.
+
+    Attributes:
+    reader_class (type, optional): The rio-tiler reader class. Defaults to `rio_tiler.io.Reader`.
+    reader_options (dict, optional): Keyword arguments forwarded to the reader class.
+    """
+
+    def __init__(self, reader_class=Reader, **reader_options):
+        """
+        Initializes the ThreadLocalReaders class.
+        """
+        self.reader_class = reader_class
+        self.reader_options = reader_options
+        self._local = threading.local()
+
+    def get(self, path):
+        """
+        Return the reader of the current thread for the given file, opening it if needed.
+
+        Args:
+            path (str or Path): The file path of the raster.
+        """
+        readers = getattr(self._local, "readers", None)
+        if readers is None:
+            readers = self._local.readers = {}
+
+        path = str(path)
+        reader = readers.get(path)
+        if reader is None:
+            reader = readers[path] = self.reader_class(path, **self.reader_options)
+        return reader
+
+    def __getstate__(self):
+        """
+        Pickle the reader settings only, worker processes open their own readers.
+        """
+        return {"reader_class": self.reader_class, "reader_options": self.reader_options}
+
+    def __setstate__(self, state):
+        """
+        Restore the reader settings with no open readers.
+        """
+        self.__init__(state["reader_class"], **state["reader_options"])
+
+    def close(self):
+        """
+        Close the readers opened by the current thread.
+        """
+        readers = getattr(self._local, "readers", None) or {}
+        self._local.readers = {}
+        for reader in readers.values():
+            reader.close()
+
+
+def map_with_readers(
+    func, items, readers: ThreadLocalReaders | None = None, max_workers: int | None = None
+):
+    """
+    Apply a function to every item using a thread pool whose threads keep their readers open.
+
+    Each worker thread pulls items from a shared iterator until it is exhausted and then closes
+    the readers it opened, so handles are reused for the whole run and released cleanly.
+
+    Args:
+        func (callable): The function to apply to each item.
+        items (iterable): The items to process.
+        readers (ThreadLocalReaders, optional): The readers used by `func`, if any.
+        max_workers (int, optional): The number of threads. Defaults to the ThreadPoolExecutor
+            default.
+    """
+    if max_workers is None:
+        max_workers = min(32, (os.cpu_count() or 1) + 4)
+
+    items = iter(items)
+    lock = threading.Lock()
+
+    def worker():
+        try:
+            while True:
+                with lock:
+                    item = next(items, None)
+                if item is None:
+                    return
+                func(item)
+        finally:
+            if readers is not None:
+                readers.close()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(worker) for _ in range(max_workers)]
+        for future in futures:
+            future.result()
+
+
+class TileIndex(NamedTuple):
+    """
+    The source pixels of a tile, gathered from a window of the source grid.
+    """
+
+    window: dict
+    rows: np.ndarray
+    cols: np.ndarray
+    valid: np.ndarray
+    bounds: tuple
+    crs: object
+
+
+class TileGather:
+    """
+    Reads the tiles of an xarray DataArray whose grid is shared by many slices (e.g. the time
+    steps of a cube or its bands), reprojecting every tile once.
+
+    The index of the source pixels is read as a tile with rio-tiler, with nearest neighbour
+    resampling as for the data, which gives the source pixel of every tile pixel and whether it
+    is within the source. Every slice is then read by gathering these pixels from the window of
+    the tile, so the tiles are the same as read with `XarrayReader`.
+
+    Attributes:
+    data (xarray.DataArray): The data, with the y and x dimensions last.
+    tile_size (int, optional): The size of the tiles in pixels. Defaults to 256.
+    """
+
+    def __init__(self, data: xr.DataArray, tile_size: int = 256):
+        """
+        Initializes the TileGather class.
+        """
+        self.data = data
+        self.tile_size = tile_size
+        self.y_dim, self.x_dim = data.rio.y_dim, data.rio.x_dim
+        self.grid = self._grid()
+        # Value of the pixels outside the source once reprojected, as set by rioxarray
+        corner = data.isel(dict.fromkeys(data.dims[:-2], 0)).isel(
+            {self.y_dim: slice(0, 2), self.x_dim: slice(0, 2)}
+        )
+        self.nodata = corner.rio.reproject(WEB_MERCATOR_CRS).rio.nodata
+
+    def __getstate__(self):
+        """
+        Pickle the gather without its grid, which is rebuilt from the data.
+        """
+        state = self.__dict__.copy()
+        del state["grid"]
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restore the gather and rebuild its grid.
+        """
+        self.__dict__.update(state)
+        self.grid = self._grid()
+
+    def _grid(self) -> xr.DataArray:
+        """
+        Return a grid of the source coordinates without data, to find the window of every tile.
+        """
+        grid = xr.DataArray(
+            np.broadcast_to(np.float32(0), (self.data.rio.height, self.data.rio.width)),
+            coords={self.y_dim: self.data[self.y_dim], self.x_dim: self.data[self.x_dim]},
+            dims=(self.y_dim, self.x_dim),
+        )
+        return grid.rio.write_crs(self.data.rio.crs).rio.write_transform(self.data.rio.transform())
+
+    def index(self, tile: mercantile.Tile) -> TileIndex:
+        """
+        Return the source pixels of a tile, raising TileOutsideBounds if it has none.
+
+        Args:
+            tile (mercantile.Tile): A mercantile tile object.
+        """
+        with XarrayReader(self.grid) as dst:
+            if not dst.tile_exists(tile.x, tile.y, tile.z):
+                raise TileOutsideBounds(f"{tile} is outside bounds")
+            bounds = dst.tms.xy_bounds(tile)
+        window = self.grid.rio.clip_box(*bounds, crs=WEB_MERCATOR_CRS, auto_expand=True)
+        y = self.grid.get_index(self.y_dim).get_loc(window[self.y_dim].values[0])
+        x = self.grid.get_index(self.x_dim).get_loc(window[self.x_dim].values[0])
+        height, width = window.shape
+        # The position of every pixel in the window, -1 outside of it
+        positions = xr.DataArray(
+            np.arange(height * width, dtype=np.int32).reshape(height, width),
+            coords=window.coords,
+            dims=window.dims,
+        )
+        positions = positions.rio.write_transform(window.rio.transform()).rio.write_nodata(-1)
+        with XarrayReader(positions) as dst:
+            img = dst.tile(tile.x, tile.y, tile.z, tilesize=self.tile_size)
+        valid = ~np.ma.getmaskarray(img.array)[0]
+        rows, cols = np.divmod(np.where(valid, img.array.data[0], 0), width)
+        return TileIndex(
+            window={
+                self.y_dim: slice(y, y + height),
+                self.x_dim: slice(x, x + width),
+            },
+            rows=rows,
+            cols=cols,
+            valid=valid,
+            bounds=img.bounds,
+            crs=img.crs,
+        )
+
+    def read(self, index: TileIndex, data: xr.DataArray | None = None) -> ImageData:
+        """
+        Read a tile of the data by gathering its source pixels.
+
+        Args:
+            index (TileIndex): The source pixels of the tile.
+            data (xarray.DataArray, optional): A slice of the data on the same grid, a band per
+                leading element (e.g. per time step). Defaults to the whole data.
+        """
+        data = self.data if data is None else data
+        block = np.asarray(data.isel(index.window).values)
+        block = block.reshape(-1, *block.shape[-2:])
+        values = block[:, index.rows, index.cols]
+        nodata = self.nodata
+        if nodata is not None:
+            values[:, ~index.valid] = nodata
+        # Masked as rio-tiler does: no data, outside the source or NaN
+        mask = np.broadcast_to(~index.valid, values.shape).copy()
+        if values.dtype.kind == "f":
+            mask |= np.isnan(values)
+        if nodata is not None:
+            mask |= values == nodata
+        return ImageData(
+            np.ma.MaskedArray(values, mask=mask),
+            bounds=index.bounds,
+            crs=index.crs,
+            nodata=nodata,
+        )
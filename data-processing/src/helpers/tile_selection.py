@@ -0,0 +1,352 @@
+"""
+Module for selecting the tiles to generate
+"""
+
+import math
+
+import geopandas as gpd
+import mercantile
+import numpy as np
+import rasterio
+import shapely
+import xarray as xr
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window
+from rio_tiler.io import Reader, XarrayReader
+from shapely.geometry.base import BaseGeometry
+
+
+def native_zoom(data) -> int:
+    """
+    Return the native zoom of a raster, the zoom whose Web Mercator pixel size is the closest to
+    the source pixel size in its CRS, as rio-tiler computes it. Higher zooms only interpolate.
+
+    Args:
+        data (str, Path or xarray.DataArray): The raster file or a DataArray with rioxarray
+            spatial dimensions.
+    """
+    if isinstance(data, xr.DataArray):
+        with XarrayReader(data) as src:
+            return int(src.maxzoom)
+    with Reader(data) as src:
+        return int(src.maxzoom)
+
+
+def intersects_bbox(tile: mercantile.Tile, bbox: list) -> bool:
+    """
+    Return whether a tile intersects a bounding box (west, south, east, north) in EPSG:4326.
+    """
+    west, south, east, north = mercantile.bounds(tile)
+    return west < bbox[2] and east > bbox[0] and south < bbox[3] and north > bbox[1]
+
+
+def hilbert_index(x: np.ndarray, y: np.ndarray, z: int) -> np.ndarray:
+    """
+    Return the position of tiles along the Hilbert curve of their zoom.
+
+    Args:
+        x (numpy.ndarray): The tile columns.
+        y (numpy.ndarray): The tile rows.
+        z (int): The zoom of the tiles.
+    """
+    x, y = np.array(x, dtype=np.int64), np.array(y, dtype=np.int64)
+    n = 1 << z
+    index = np.zeros_like(x)
+    s = n >> 1
+    while s > 0:
+        rx, ry = (x & s) > 0, (y & s) > 0
+        index += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant so that the curve is continuous
+        flip = ~ry & rx
+        x[flip], y[flip] = n - 1 - x[flip], n - 1 - y[flip]
+        swap = ~ry
+        x[swap], y[swap] = y[swap], x[swap]
+        s >>= 1
+    return index
+
+
+def morton_index(x: np.ndarray, y: np.ndarray, z: int) -> np.ndarray:
+    """
+    Return the position of tiles along the Morton (Z-order) curve of their zoom.
+
+    Args:
+        x (numpy.ndarray): The tile columns.
+        y (numpy.ndarray): The tile rows.
+        z (int): The zoom of the tiles.
+    """
+    x, y = np.asarray(x, dtype=np.int64), np.asarray(y, dtype=np.int64)
+    index = np.zeros_like(x)
+    for bit in range(z):
+        index |= ((x >> bit) & 1) << (2 * bit) | ((y >> bit) & 1) << (2 * bit + 1)
+    return index
+
+
+CURVES = {"hilbert": hilbert_index, "morton": morton_index}
+
+
+def order_tiles(tiles: list, curve: str = "hilbert") -> list:
+    """
+    Return the tiles sorted by zoom and then along a space-filling curve.
+
+    Tiles that are close on the curve are close on the map, and every aligned block of 4^k tiles
+    is a run of the curve, so batches of consecutive tiles (e.g. 64 tiles, 8 x 8) cover compact
+    areas. Concurrent workers then read the same source blocks and overview level together,
+    instead of evicting each other's blocks from the GDAL cache.
+
+    Args:
+        tiles (list): The mercantile tiles.
+        curve (str, optional): "hilbert" or "morton". Defaults to "hilbert".
+    """
+    index = CURVES.get(curve)
+    if not index:
+        raise ValueError(f"Unsupported curve: {curve}")
+    if not tiles:
+        return []
+
+    x, y, z = np.array([(tile.x, tile.y, tile.z) for tile in tiles], dtype=np.int64).T
+    position = np.zeros_like(x)
+    for zoom in np.unique(z):
+        at_zoom = z == zoom
+        position[at_zoom] = index(x[at_zoom], y[at_zoom], int(zoom))
+    return [tiles[i] for i in np.lexsort((position, z))]
+
+
+def select_tiles(bbox: list, zooms: list, filters: list) -> list:
+    """
+    Return the tiles of the given zooms within the bounding box kept by every filter.
+
+    Tiles are walked top-down from the minimum zoom: the children of a tile are only considered
+    if the tile is kept, so a tile discarded at a low zoom prunes all its descendants. Filters
+    must therefore never discard a tile whose descendants could be kept.
+
+    Args:
+        bbox (list): The bounding box (west, south, east, north) of the data in EPSG:4326.
+        zooms (list): The zoom levels.
+        filters (list): Functions taking a list of tiles and returning the ones to keep.
+    """
+    zooms = sorted(int(z) for z in zooms)
+    if not zooms:
+        return []
+
+    tiles = []
+    candidates = list(mercantile.tiles(*bbox, zooms=zooms[0]))
+    for z in range(zooms[0], zooms[-1] + 1):
+        for keep in filters:
+            candidates = keep(candidates)
+        if z in zooms:
+            tiles.extend(candidates)
+        if z < zooms[-1]:
+            candidates = [
+                child
+                for tile in candidates
+                for child in mercantile.children(tile)
+                if intersects_bbox(child, bbox)
+            ]
+    return tiles
+
+
+class TileFootprint:
+    """
+    Selects the tiles that intersect a clipping geometry, e.g. a country boundary.
+
+    The geometry is split into its parts and indexed in an STRtree.
+
+    Attributes:
+    geometry (geopandas.GeoDataFrame, geopandas.GeoSeries or shapely geometry): The clipping
+        geometry. GeoPandas objects are reprojected to EPSG:4326, shapely geometries must already
+        be in EPSG:4326.
+    """
+
+    def __init__(self, geometry: gpd.GeoDataFrame | gpd.GeoSeries | BaseGeometry):
+        """
+        Initializes the TileFootprint class.
+        """
+        if isinstance(geometry, gpd.GeoDataFrame | gpd.GeoSeries):
+            if geometry.crs is not None:
+                geometry = geometry.to_crs("EPSG:4326")
+            geometry = geometry.union_all()
+        self.geometry = geometry
+        self.parts = shapely.get_parts(geometry)
+        self.tree = shapely.STRtree(self.parts)
+
+    def __getstate__(self):
+        """
+        Pickle the geometry only, the spatial index is rebuilt.
+        """
+        return {"geometry": self.geometry}
+
+    def __setstate__(self, state):
+        """
+        Restore the footprint and its spatial index.
+        """
+        self.__init__(state["geometry"])
+
+    def filter(self, tiles: list) -> list:
+        """
+        Return the tiles that intersect the geometry.
+        """
+        if not tiles:
+            return []
+        boxes = shapely.box(*np.array([mercantile.bounds(tile) for tile in tiles]).T)
+        hits = np.unique(self.tree.query(boxes, predicate="intersects")[0])
+        return [tiles[i] for i in hits]
+
+    def intersects(self, tile: mercantile.Tile) -> bool:
+        """
+        Return whether a tile intersects the geometry.
+        """
+        return bool(self.filter([tile]))
+
+
+class CoverageMask:
+    """
+    Selects the tiles that contain valid data, from a coarse mask of the source.
+
+    Every cell of the mask is valid if any source pixel under it is valid, and the mask is grown
+    by one cell, so a tile is only discarded when it is certainly empty.
+
+    Attributes:
+    valid (numpy.ndarray): The boolean mask of the cells with valid data.
+    transform (affine.Affine): The geotransform of the mask.
+    crs (rasterio.crs.CRS): The coordinate reference system of the mask.
+    """
+
+    # Maximum number of cells of the mask on each side
+    MAX_SIZE = 4096
+
+    def __init__(self, valid: np.ndarray, transform: Affine, crs: CRS):
+        """
+        Initializes the CoverageMask class.
+        """
+        self.valid = valid
+        self.transform = transform
+        self.crs = CRS.from_user_input(crs)
+        # Grow the mask by one cell, tiles may resample the pixels just outside them
+        padded = np.pad(valid, 1)
+        grown = np.zeros_like(valid)
+        for dy in range(3):
+            for dx in range(3):
+                grown |= padded[dy : dy + valid.shape[0], dx : dx + valid.shape[1]]
+        # Summed-area table, to count the valid cells of any window in constant time
+        self._counts = np.pad(grown.astype(np.int64).cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+
+    @classmethod
+    def from_raster(cls, path, max_size: int | None = None):
+        """
+        Build the coverage mask of a raster file from its dataset mask, read in strips.
+
+        Args:
+            path (str or Path): The file path of the raster.
+            max_size (int, optional): The maximum number of cells on each side. Defaults to
+                `MAX_SIZE`.
+        """
+        with rasterio.open(path) as src:
+            factor = math.ceil(max(src.width, src.height) / (max_size or cls.MAX_SIZE))
+            rows, cols = math.ceil(src.height / factor), math.ceil(src.width / factor)
+            valid = np.zeros((rows, cols), dtype=bool)
+            # Strips of about 16M pixels, a whole number of cells high
+            strip = max(1, 2**24 // (src.width * factor))
+            for row in range(0, rows, strip):
+                window = Window(
+                    0, row * factor, src.width, min(strip * factor, src.height - row * factor)
+                )
+                mask = src.dataset_mask(window=window) > 0
+                valid[row : row + strip] = _any_blocks(mask, factor)
+            return cls(valid, src.transform * Affine.scale(factor), src.crs)
+
+    @classmethod
+    def from_dataarray(cls, da: xr.DataArray, max_size: int | None = None):
+        """
+        Build the coverage mask of a DataArray, valid where any value of the other dimensions
+        (e.g. time) is not nodata.
+
+        Args:
+            da (xarray.DataArray): The data, with rioxarray spatial dimensions.
+            max_size (int, optional): The maximum number of cells on each side. Defaults to
+                `MAX_SIZE`.
+        """
+        y_dim, x_dim = da.rio.y_dim, da.rio.x_dim
+        factor = math.ceil(max(da.sizes[x_dim], da.sizes[y_dim]) / (max_size or cls.MAX_SIZE))
+        valid = da.notnull()
+        if da.rio.nodata is not None:
+            valid &= da != da.rio.nodata
+        other = [dim for dim in da.dims if dim not in (y_dim, x_dim)]
+        if other:
+            valid = valid.any(other)
+        valid = valid.coarsen({y_dim: factor, x_dim: factor}, boundary="pad").max().fillna(False)
+        return cls(
+            valid.transpose(y_dim, x_dim).values.astype(bool),
+            da.rio.transform() * Affine.scale(factor),
+            da.rio.crs or "EPSG:4326",
+        )
+
+    @staticmethod
+    def union(masks: list) -> "CoverageMask":
+        """
+        Return the mask valid wherever any of the masks is, they must share the same grid.
+        """
+        first = masks[0]
+        for mask in masks[1:]:
+            if (mask.valid.shape, mask.transform, mask.crs) != (
+                first.valid.shape,
+                first.transform,
+                first.crs,
+            ):
+                raise ValueError("Coverage masks must share the same grid.")
+        valid = np.logical_or.reduce([mask.valid for mask in masks])
+        return CoverageMask(valid, first.transform, first.crs)
+
+    def __getstate__(self):
+        """
+        Pickle the mask only, the summed-area table is rebuilt.
+        """
+        return {"valid": self.valid, "transform": self.transform, "crs": self.crs.to_wkt()}
+
+    def __setstate__(self, state):
+        """
+        Restore the mask and its summed-area table.
+        """
+        self.__init__(state["valid"], state["transform"], state["crs"])
+
+    def filter(self, tiles: list) -> list:
+        """
+        Return the tiles that may contain valid data.
+        """
+        if not tiles:
+            return []
+        bounds = [mercantile.bounds(tile) for tile in tiles]
+        if not self.crs.is_geographic:
+            bounds = [transform_bounds("EPSG:4326", self.crs, *b) for b in bounds]
+        west, south, east, north = np.array(bounds).T
+
+        # Window of the mask cells under every tile, with the cells it partly covers
+        inverse = ~self.transform
+        cols_a, rows_a = inverse * (west, north)
+        cols_b, rows_b = inverse * (east, south)
+        rows, cols = self.valid.shape
+        row0 = np.clip(np.floor(np.minimum(rows_a, rows_b)), 0, rows).astype(int)
+        row1 = np.clip(np.ceil(np.maximum(rows_a, rows_b)), 0, rows).astype(int)
+        col0 = np.clip(np.floor(np.minimum(cols_a, cols_b)), 0, cols).astype(int)
+        col1 = np.clip(np.ceil(np.maximum(cols_a, cols_b)), 0, cols).astype(int)
+
+        counts = self._counts
+        n = counts[row1, col1] - counts[row0, col1] - counts[row1, col0] + counts[row0, col0]
+        return [tile for tile, count in zip(tiles, n, strict=True) if count > 0]
+
+    def intersects(self, tile: mercantile.Tile) -> bool:
+        """
+        Return whether a tile may contain valid data.
+        """
+        return bool(self.filter([tile]))
+
+
+def _any_blocks(mask: np.ndarray, factor: int) -> np.ndarray:
+    """
+    Return whether any pixel of every factor x factor block of a mask is set.
+    """
+    rows, cols = math.ceil(mask.shape[0] / factor), math.ceil(mask.shape[1] / factor)
+    padded = np.zeros((rows * factor, cols * factor), dtype=bool)
+    padded[: mask.shape[0], : mask.shape[1]] = mask
+    return padded.reshape(rows, factor, cols, factor).any(axis=(1, 3))
@@ -0,0 +1,379 @@
+"""
+Module for serving raster tiles rendered on demand
+"""
+
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from pathlib import Path
+
+import mercantile
+from helpers.raster_tiles import RasterTiles, TileEngine
+from helpers.tile_readers import map_with_readers
+from helpers.tile_timings import NullTimings
+
+# Content type of every tile file extension
+CONTENT_TYPES = {"png": "image/png", "webp": "image/webp", "jpg": "image/jpeg"}
+TILE_PATH = re.compile(r"^/(?P<layer>[^/]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?P<ext>\w+)$")
+
+
+class TileCache:
+    """
+    Keeps the most recently used tiles in memory and on disk, each bounded in bytes.
+
+    Tiles evicted from memory are still on disk, and the disk cache survives restarts: its
+    least recently used files are removed first, by their modification time, which is refreshed
+    on every hit. Empty tiles are cached in memory only, as empty payloads, and every tile in
+    memory counts `ENTRY_SIZE` bytes besides its payload, so that empty tiles are bounded too.
+
+    Attributes:
+    memory_size (int, optional): The maximum bytes of tiles kept in memory. Defaults to 256 MB.
+    folder (str or Path, optional): The folder of the disk cache, no disk cache if None.
+        Defaults to None.
+    disk_size (int, optional): The maximum bytes of tiles kept on disk. Defaults to 10 GB.
+    """
+
+    # Bytes counted for every tile in memory besides its payload
+    ENTRY_SIZE = 256
+    # Suffix of the files being written, left over if the server stopped meanwhile
+    TEMP_SUFFIX = ".tmp"
+
+    def __init__(
+        self,
+        memory_size: int = 256 * 2**20,
+        folder: Path | None = None,
+        disk_size: int = 10 * 2**30,
+    ):
+        """
+        Initializes the TileCache class.
+        """
+        self.memory_size = memory_size
+        self.folder = Path(folder) if folder is not None else None
+        self.disk_size = disk_size
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        if self.folder is not None:
+            self._load_disk()
+
+    def _load_disk(self):
+        """
+        Index the files already in the disk cache, least recently used first, and remove the
+        partial files left over.
+        """
+        files = []
+        for root, _, names in os.walk(self.folder):
+            for name in names:
+                path = Path(root) / name
+                if name.endswith(self.TEMP_SUFFIX):
+                    path.unlink(missing_ok=True)
+                    continue
+                stat = path.stat()
+                files.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(files):
+            self._disk[path] = size
+            self._disk_bytes += size
+
+    def _path(self, key: tuple) -> Path:
+        layer, z, x, y, extension = key
+        return self.folder / layer / str(z) / str(x) / f"{y}.{extension}"
+
+    def get(self, key: tuple) -> bytes | None:
+        """
+        Return the cached payload of a tile, None if it is not cached.
+
+        Args:
+            key (tuple): The layer, z, x, y and extension of the tile.
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            path = self._path(key) if self.folder is not None else None
+            if path is None or path not in self._disk:
+                return None
+            self._disk.move_to_end(path)
+        try:
+            payload = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        self._put_memory(key, payload)
+        return payload
+
+    def put(self, key: tuple, payload: bytes):
+        """
+        Cache the payload of a tile.
+
+        Args:
+            key (tuple): The layer, z, x, y and extension of the tile.
+            payload (bytes): The encoded tile, empty for an empty tile.
+        """
+        self._put_memory(key, payload)
+        if self.folder is None or not payload:
+            return
+
+        path = self._path(key)
+        os.makedirs(path.parent, exist_ok=True)
+        # Written aside and moved, so that readers never see a partial tile
+        with tempfile.NamedTemporaryFile(
+            dir=path.parent, suffix=self.TEMP_SUFFIX, delete=False
+        ) as f:
+            f.write(payload)
+        os.replace(f.name, path)
+        with self._lock:
+            self._disk_bytes += len(payload) - self._disk.pop(path, 0)
+            self._disk[path] = len(payload)
+            evicted = []
+            while self._disk_bytes > self.disk_size and len(self._disk) > 1:
+                old, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                evicted.append(old)
+        for old in evicted:
+            old.unlink(missing_ok=True)
+
+    def _put_memory(self, key: tuple, payload: bytes):
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= len(old) + self.ENTRY_SIZE
+            self._memory[key] = payload
+            self._memory_bytes += len(payload) + self.ENTRY_SIZE
+            while self._memory_bytes > self.memory_size and len(self._memory) > 1:
+                _, old = self._memory.popitem(last=False)
+                self._memory_bytes -= len(old) + self.ENTRY_SIZE
+
+
+class TileServer:
+    """
+    Serves the tiles of raster layers over HTTP, rendered on demand from their source (e.g. a
+    COG or a Zarr store opened with xarray) and cached.
+
+    Tiles are requested as `/{layer}/{z}/{x}/{y}.{extension}`, with the extension of the layer
+    tile format. Tiles without data get an empty 204 response. `/` lists the layers with their
+    URL template, zooms and bounds.
+
+    Attributes:
+    layers (dict): The RasterTiles, or tile engines, keyed by layer name. Their zooms, colormap,
+        range, tile format, clipping geometry and coverage settings are used as for pre-rendered
+        tiles, their output folder is not written to and their timings are not recorded.
+    cache (TileCache, optional): The tile cache. Defaults to a memory cache of 256 MB.
+    max_workers (int, optional): The number of threads rendering tiles. Defaults to the
+        ThreadPoolExecutor default.
+    """
+
+    def __init__(
+        self,
+        layers: dict,
+        cache: TileCache | None = None,
+        max_workers: int | None = None,
+    ):
+        """
+        Initializes the TileServer class.
+        """
+        self.layers = {}
+        for name, layer in layers.items():
+            engine = layer.engine_instance if isinstance(layer, RasterTiles) else layer
+            if not isinstance(engine, TileEngine):
+                raise ValueError(f"Unsupported layer: {name}")
+            engine.prepare()
+            engine.timings = NullTimings()
+            self.layers[name] = engine
+        self.cache = cache or TileCache()
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self._lock = threading.Lock()
+        self._rendering = {}
+
+    def tile(self, layer: str, tile: mercantile.Tile) -> bytes | None:
+        """
+        Return the encoded tile of a layer, from the cache or rendered and cached.
+
+        Concurrent requests of the same tile wait for a single render.
+
+        Returns:
+        bytes: The encoded tile, empty if the tile has no data. None if the layer or the zoom
+            is not served.
+        """
+        engine = self.layers.get(layer)
+        if engine is None or not engine.min_z <= tile.z <= engine.max_z:
+            return None
+        key = (layer, tile.z, tile.x, tile.y, engine.encoder.extension)
+        payload = self.cache.get(key)
+        if payload is not None:
+            return payload
+
+        with self._lock:
+            lock = self._rendering.setdefault(key, threading.Lock())
+        with lock:
+            payload = self.cache.get(key)
+            if payload is None:
+                payload = engine.render_tile(tile) or b""
+                self.cache.put(key, payload)
+        with self._lock:
+            self._rendering.pop(key, None)
+        return payload
+
+    def prewarm(self, max_z: int, layers: list | None = None):
+        """
+        Render and cache ahead every tile of the layers from their minimum zoom to `max_z`.
+
+        Args:
+            max_z (int): The maximum zoom rendered.
+            layers (list, optional): The names of the layers. Defaults to every layer.
+        """
+        for name in layers or list(self.layers):
+            engine = self.layers[name]
+            zooms = list(range(engine.min_z, min(max_z, engine.max_z) + 1))
+            map_with_readers(
+                lambda tile, name=name: self.tile(name, tile),
+                engine.tiles(zooms),
+                engine.readers,
+                self.max_workers,
+            )
+            print(f"Pre-warmed {name} up to zoom {max_z}")
+
+    def index(self, base_url: str = "") -> dict:
+        """
+        Return the URL template, zooms and bounds of every layer.
+        """
+        return {
+            name: {
+                "tiles": [f"{base_url}/{name}/{{z}}/{{x}}/{{y}}.{engine.encoder.extension}"],
+                "minzoom": int(engine.min_z),
+                "maxzoom": int(engine.max_z),
+                "bounds": list(engine.bbox),
+            }
+            for name, engine in self.layers.items()
+        }
+
+    def serve(self, host: str = "127.0.0.1", port: int = 8000):
+        """
+        Serve the tiles until interrupted.
+
+        Args:
+            host (str, optional): The address to listen on. Defaults to "127.0.0.1".
+            port (int, optional): The port to listen on. Defaults to 8000.
+        """
+        server = _PooledHTTPServer((host, port), _TileRequestHandler, self, self.max_workers)
+        print(f"Serving tiles on http://{host}:{port}/")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.close_readers()
+
+    def close_readers(self):
+        """
+        Close the readers of every layer opened by the calling thread, e.g. by calling `tile`.
+        """
+        for engine in self.layers.values():
+            if engine.readers is not None:
+                engine.readers.close()
+
+
+class _PooledHTTPServer(HTTPServer):
+    """
+    Handles the requests in a fixed pool of threads, so that every thread keeps its readers
+    open across requests.
+    """
+
+    def __init__(self, address, handler_class, tile_server: TileServer, max_workers: int):
+        """
+        Initializes the _PooledHTTPServer class.
+        """
+        super().__init__(address, handler_class)
+        self.tile_server = tile_server
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def process_request(self, request, client_address):
+        """
+        Handle a request in the thread pool.
+        """
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        """
+        Stop listening, wait for the requests being handled and close the readers of the pool.
+        """
+        super().server_close()
+        # One job per thread: every job holds its thread until all the threads run one
+        barrier = threading.Barrier(self.max_workers)
+        for _ in range(self.max_workers):
+            self.executor.submit(self._close_readers, barrier)
+        self.executor.shutdown(wait=True)
+
+    def _close_readers(self, barrier: threading.Barrier):
+        self.tile_server.close_readers()
+        try:
+            barrier.wait(timeout=60)
+        except threading.BrokenBarrierError:
+            pass
+
+
+class _TileRequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers the tile and index requests of the tile server.
+    """
+
+    def do_GET(self):  # noqa: N802
+        """
+        Answer a GET request.
+        """
+        if self.path in ("", "/"):
+            host = self.headers.get("Host", "")
+            body = json.dumps(self.server.tile_server.index(f"http://{host}")).encode()
+            return self._send(200, body, "application/json")
+
+        match = TILE_PATH.match(self.path.split("?")[0])
+        engine = match and self.server.tile_server.layers.get(match["layer"])
+        if not engine or match["ext"] != engine.encoder.extension:
+            return self._send(404)
+        tile = mercantile.Tile(int(match["x"]), int(match["y"]), int(match["z"]))
+        if not (tile.x < 2**tile.z and tile.y < 2**tile.z):
+            return self._send(404)
+        return self._send_tile(match["layer"], tile, CONTENT_TYPES[match["ext"]])
+
+    def _send_tile(self, layer: str, tile: mercantile.Tile, content_type: str):
+        try:
+            payload = self.server.tile_server.tile(layer, tile)
+        except Exception as e:
+            self.log_error("An error occurred while rendering %s: %s", self.path, e)
+            return self._send(500)
+        if payload is None:
+            return self._send(404)
+        if not payload:
+            return self._send(204)
+        return self._send(200, payload, content_type)
+
+    def _send(self, status: int, body: bytes = b"", content_type: str | None = None):
+        self.send_response(status)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        if content_type:
+            self.send_header("Content-Type", content_type)
+            self.send_header("Cache-Control", "public, max-age=3600")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_request(self, code="-", size="-"):
+        """
+        Only log the errors, not every request.
+        """
@@ -0,0 +1,209 @@
+"""
+Module for timing the stages of tile generation
+"""
+
+import json
+import os
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+TIMINGS_FILE = "timings.json"
+# Tile counters of every zoom, besides the bytes written
+STATUSES = ("written", "skipped", "errored")
+
+
+class TileTimings:
+    """
+    Records, per zoom, the duration of every stage of every tile (e.g. read, render, encode and
+    write), the tiles written, skipped (outside the data bounds) and errored, and the bytes
+    written.
+
+    Stages run for a whole batch of tiles at once are shared evenly between its tiles. The wall
+    time of a zoom spans from the start of its first stage to the end of its last one, across
+    every worker.
+    """
+
+    def __init__(self):
+        """
+        Initializes the TileTimings class.
+        """
+        self.durations = {}
+        self.counts = {}
+        self.spans = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        """
+        Pickle the timings without their lock.
+        """
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restore the timings with a new lock.
+        """
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _span(self, zoom: int, start: float, end: float):
+        span = self.spans.setdefault(zoom, [start, end])
+        span[0], span[1] = min(span[0], start), max(span[1], end)
+
+    def add(self, zoom: int, stage: str, seconds: float, n: int = 1):
+        """
+        Record the duration of a stage.
+
+        Args:
+            zoom (int): The zoom of the tiles.
+            stage (str): The name of the stage.
+            seconds (float): The duration of the stage.
+            n (int, optional): The number of tiles the stage ran for. Defaults to 1.
+        """
+        zoom, end = int(zoom), time.time()
+        with self._lock:
+            durations = self.durations.setdefault(zoom, {}).setdefault(stage, array("d"))
+            durations.extend([seconds / n] * n)
+            self._span(zoom, end - seconds, end)
+
+    @contextmanager
+    def stage(self, zoom: int, stage: str, n: int = 1):
+        """
+        Time a stage, only recorded if it completes.
+
+        Args:
+            zoom (int): The zoom of the tiles.
+            stage (str): The name of the stage.
+            n (int, optional): The number of tiles the stage runs for. Defaults to 1.
+        """
+        start = time.perf_counter()
+        yield
+        self.add(zoom, stage, time.perf_counter() - start, n)
+
+    def count(self, zoom: int, status: str, n: int = 1):
+        """
+        Add to a counter of a zoom, "written", "skipped", "errored" or "bytes".
+        """
+        with self._lock:
+            counts = self.counts.setdefault(int(zoom), {})
+            counts[status] = counts.get(status, 0) + n
+
+    def drain(self) -> dict:
+        """
+        Return and reset the timings so far.
+
+        Used by worker processes to hand their timings over to the parent process.
+        """
+        with self._lock:
+            state = {"durations": self.durations, "counts": self.counts, "spans": self.spans}
+            self.durations, self.counts, self.spans = {}, {}, {}
+        return state
+
+    def merge(self, state: dict):
+        """
+        Add the timings drained from a worker process.
+        """
+        with self._lock:
+            for zoom, stages in state["durations"].items():
+                for stage, durations in stages.items():
+                    self.durations.setdefault(zoom, {}).setdefault(stage, array("d")).extend(
+                        durations
+                    )
+            for zoom, counts in state["counts"].items():
+                for status, n in counts.items():
+                    zoom_counts = self.counts.setdefault(zoom, {})
+                    zoom_counts[status] = zoom_counts.get(status, 0) + n
+            for zoom, (start, end) in state["spans"].items():
+                self._span(zoom, start, end)
+
+    def report(self) -> dict:
+        """
+        Return the counters, the p50 and p95 latency of every stage in milliseconds and the tiles
+        written per second, of every zoom and of all zooms.
+        """
+
+        def summary(counts, stages, seconds):
+            result = {status: counts.get(status, 0) for status in STATUSES}
+            result["bytes"] = counts.get("bytes", 0)
+            result["seconds"] = round(seconds, 3)
+            result["tiles_per_second"] = round(result["written"] / seconds, 2) if seconds else 0
+            result["stages"] = {
+                stage: {
+                    "p50_ms": round(float(np.percentile(durations, 50)) * 1000, 3),
+                    "p95_ms": round(float(np.percentile(durations, 95)) * 1000, 3),
+                    "total_s": round(float(np.sum(durations)), 3),
+                }
+                for stage, durations in stages.items()
+                if len(durations)
+            }
+            return result
+
+        with self._lock:
+            zooms = sorted(set(self.counts) | set(self.durations))
+            report = {
+                "zooms": {
+                    str(zoom): summary(
+                        self.counts.get(zoom, {}),
+                        self.durations.get(zoom, {}),
+                        self._seconds([zoom]),
+                    )
+                    for zoom in zooms
+                }
+            }
+            counts, stages = {}, {}
+            for zoom in zooms:
+                for status, n in self.counts.get(zoom, {}).items():
+                    counts[status] = counts.get(status, 0) + n
+                for stage, durations in self.durations.get(zoom, {}).items():
+                    stages.setdefault(stage, array("d")).extend(durations)
+            report["total"] = summary(counts, stages, self._seconds(zooms))
+            return report
+
+    def _seconds(self, zooms: list) -> float:
+        spans = [self.spans[zoom] for zoom in zooms if zoom in self.spans]
+        if not spans:
+            return 0
+        return max(end for _, end in spans) - min(start for start, _ in spans)
+
+
+class NullTimings(TileTimings):
+    """
+    Timings that record nothing, for engines rendering tiles indefinitely, e.g. when serving them,
+    whose timings would otherwise grow with every tile.
+    """
+
+    def add(self, zoom: int, stage: str, seconds: float, n: int = 1):
+        """
+        Ignore the duration of a stage.
+        """
+
+    def count(self, zoom: int, status: str, n: int = 1):
+        """
+        Ignore a counter of a zoom.
+        """
+
+
+def write_timings(path: Path, elapsed: float, **timings) -> dict:
+    """
+    Write the report of the timings of a run to a JSON file.
+
+    Args:
+        path (str or Path): The path of the JSON file.
+        elapsed (float): The wall time of the whole run in seconds.
+        **timings (TileTimings): The timings of every phase of the run, e.g. `tiles=...`.
+
+    Returns:
+    dict: The report.
+    """
+    report = {"elapsed_s": round(elapsed, 3)}
+    report.update({name: t.report() for name, t in timings.items()})
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return report
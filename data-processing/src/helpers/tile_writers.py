@@ -0,0 +1,588 @@
+"""
+Module for writing rendered tiles
+"""
+
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+from pathlib import Path
+
+import mercantile
+from PIL import Image
+
+DEDUPLICATE_MODES = (None, "hardlink", "manifest")
+DUPLICATES_MANIFEST = "duplicates.json"
+
+
+def is_empty(image: Image.Image) -> bool:
+    """
+    Return whether an image is fully transparent. Images without alpha are never empty.
+    """
+    return "A" in image.getbands() and image.getchannel("A").getextrema() == (0, 0)
+
+
+class TileWriter:
+    """
+    Represents a base class for tile writers.
+
+    Writers count, per zoom, the tiles written, the empty tiles skipped and the duplicated tiles,
+    and record the tiles they have stored in the manifest, if any.
+
+    Attributes:
+    skip_empty (bool, optional): Do not write fully transparent tiles. Defaults to False.
+    manifest (TileManifest, optional): The manifest of the completed tiles. Defaults to None.
+    """
+
+    # Whether worker processes can write on their own or must send the tiles to the parent
+    process_safe = True
+
+    def __init__(self, skip_empty: bool = False):
+        """
+        Initializes the TileWriter class.
+        """
+        self.skip_empty = skip_empty
+        self.manifest = None
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        """
+        Pickle the writer without its lock.
+        """
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        """
+        Restore the writer with a new lock.
+        """
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _count(self, zoom: int, status: str, n: int = 1):
+        with self._lock:
+            counts = self.counts.setdefault(int(zoom), {})
+            counts[status] = counts.get(status, 0) + n
+
+    def _write(self, tile: mercantile.Tile, payload: bytes) -> str:
+        """
+        Store the tile and return its status, "written" or "duplicate".
+        """
+        raise NotImplementedError("This method should be implemented by subclasses.")
+
+    def write(self, tile: mercantile.Tile, payload: bytes, empty: bool = False):
+        """
+        Write a tile.
+
+        Args:
+            tile (mercantile.Tile): A mercantile tile object.
+            payload (bytes): The encoded tile.
+            empty (bool, optional): Whether the tile is fully transparent. Defaults to False.
+        """
+        if empty and self.skip_empty:
+            self._count(tile.z, "empty")
+        else:
+            self._count(tile.z, self._write(tile, payload))
+        if self.manifest is not None:
+            self.manifest.add([tile])
+
+    def drain(self):
+        """
+        Return and reset the tiles pending for another writer and the counts so far.
+
+        Used by worker processes to hand their work over to the writer of the parent process.
+        """
+        with self._lock:
+            counts, self.counts = self.counts, {}
+        return [], counts
+
+    def merge(self, tiles: list, counts: dict):
+        """
+        Write the tiles and add the counts drained from a worker process writer.
+        """
+        for tile, payload, empty in tiles:
+            self.write(tile, payload, empty)
+        for zoom, zoom_counts in counts.items():
+            for status, n in zoom_counts.items():
+                self._count(zoom, status, n)
+
+    def close(self):
+        """
+        Flush anything still pending.
+        """
+
+    def report(self):
+        """
+        Return the counts per zoom as printable lines.
+        """
+        return [
+            f"Zoom {zoom}: {counts.get('written', 0)} written, "
+            f"{counts.get('empty', 0)} empty skipped, "
+            f"{counts.get('duplicate', 0)} deduplicated"
+            for zoom, counts in sorted(self.counts.items())
+        ]
+
+
+class BufferedTileWriter(TileWriter):
+    """
+    Keeps the tiles in memory until they are drained.
+
+    Used in worker processes when the real writer has to see every tile itself.
+    """
+
+    process_safe = False
+
+    def __init__(self, skip_empty: bool = False):
+        """
+        Initializes the BufferedTileWriter class.
+        """
+        super().__init__(skip_empty)
+        self.tiles = []
+
+    def write(self, tile: mercantile.Tile, payload: bytes, empty: bool = False):
+        """
+        Keep a tile until it is drained.
+        """
+        if empty and self.skip_empty:
+            # Empty tiles are only sent back to be counted and recorded, not their payload
+            payload = b""
+        with self._lock:
+            self.tiles.append((tile, payload, empty))
+
+    def drain(self):
+        """
+        Return and reset the pending tiles and the counts so far.
+        """
+        _, counts = super().drain()
+        with self._lock:
+            tiles, self.tiles = self.tiles, []
+        return tiles, counts
+
+
+class DirectoryTileWriter(TileWriter):
+    """
+    Writes tiles as `{z}/{x}/{y}.{extension}` files.
+
+    With deduplication every distinct payload is stored once: later copies are either
+    hardlinked to the first file ("hardlink") or not written at all and listed in a
+    `duplicates.json` manifest mapping their path to the path of the stored copy ("manifest").
+
+    Attributes:
+    output_folder (str): The folder where the tiles will be written.
+    skip_empty (bool, optional): Do not write fully transparent tiles. Defaults to False.
+    deduplicate (str, optional): None, "hardlink" or "manifest". Defaults to None.
+    extension (str, optional): The file extension of the tiles. Defaults to "png".
+    """
+
+    def __init__(
+        self,
+        output_folder: Path,
+        skip_empty: bool = False,
+        deduplicate: str | None = None,
+        extension: str = "png",
+    ):
+        """
+        Initializes the DirectoryTileWriter class.
+        """
+        if deduplicate not in DEDUPLICATE_MODES:
+            raise ValueError(f"Unsupported deduplicate mode: {deduplicate}")
+
+        super().__init__(skip_empty)
+        self.output_folder = output_folder
+        self.deduplicate = deduplicate
+        self.extension = extension
+        self.hashes = {}
+        self.duplicates = {}
+
+    @property
+    def process_safe(self):
+        """
+        Deduplication needs to see every tile, so it is only process safe without it.
+        """
+        return self.deduplicate is None
+
+    def tile_path(self, tile: mercantile.Tile) -> str:
+        """
+        Return the path of a tile relative to the output folder.
+        """
+        return os.path.join(str(tile.z), str(tile.x), f"{tile.y}.{self.extension}")
+
+    def _write(self, tile: mercantile.Tile, payload: bytes) -> str:
+        path = self.tile_path(tile)
+        tile_file = os.path.join(self.output_folder, path)
+        os.makedirs(os.path.dirname(tile_file), exist_ok=True)
+
+        original = None
+        if self.deduplicate:
+            digest = hashlib.blake2b(payload, digest_size=16).digest()
+            with self._lock:
+                original = self.hashes.get(digest)
+
+        if original is None:
+            # Replace rather than overwrite, the old file may be hardlinked by other tiles
+            with open(f"{tile_file}.tmp", "wb") as f:
+                f.write(payload)
+            os.replace(f"{tile_file}.tmp", tile_file)
+            if not self.deduplicate:
+                return "written"
+            # Register the payload only once its file exists, so that it can be linked
+            with self._lock:
+                original = self.hashes.setdefault(digest, path)
+            if original == path:
+                return "written"
+
+        # Another tile already stored the same payload
+        if os.path.lexists(tile_file):
+            os.remove(tile_file)
+        if self.deduplicate == "hardlink":
+            os.link(os.path.join(self.output_folder, original), tile_file)
+        else:
+            with self._lock:
+                self.duplicates[path] = original
+        return "duplicate"
+
+    def close(self):
+        """
+        Write the duplicates manifest, keeping the duplicates of previous runs still valid.
+        """
+        if self.deduplicate != "manifest":
+            return
+
+        manifest_path = os.path.join(self.output_folder, DUPLICATES_MANIFEST)
+        duplicates = {}
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                duplicates = json.load(f)
+        # Tiles stored as files by this run are no longer duplicates
+        duplicates = {
+            path: original
+            for path, original in duplicates.items()
+            if not os.path.exists(os.path.join(self.output_folder, path))
+        }
+        duplicates.update(self.duplicates)
+        # Originals that became duplicates themselves point to their own original
+        duplicates = {
+            path: duplicates.get(original, original) for path, original in duplicates.items()
+        }
+        with open(manifest_path, "w") as f:
+            json.dump(duplicates, f)
+
+
+class MBTilesWriter(TileWriter):
+    """
+    Writes tiles into a single MBTiles (SQLite) file.
+
+    Tiles from any number of threads, or from worker processes through the parent process, are
+    queued to a single writer thread that owns the database and inserts them in batched
+    transactions. With deduplication the MBTiles `map`/`images` layout is used, so every
+    distinct payload is stored once.
+
+    Attributes:
+    path (str): The path of the MBTiles file. An existing file is replaced, or updated when
+        resuming.
+    skip_empty (bool, optional): Do not write fully transparent tiles. Defaults to False.
+    deduplicate (str, optional): Store identical tiles once if not None. Defaults to None.
+    tile_format (str, optional): The format of the tiles for the metadata. Defaults to "png".
+    """
+
+    process_safe = False
+    BATCH_SIZE = 1000
+    QUEUE_SIZE = 10000
+
+    def __init__(
+        self,
+        path: Path,
+        skip_empty: bool = False,
+        deduplicate: str | None = None,
+        tile_format: str = "png",
+    ):
+        """
+        Initializes the MBTilesWriter class.
+        """
+        if deduplicate not in DEDUPLICATE_MODES:
+            raise ValueError(f"Unsupported deduplicate mode: {deduplicate}")
+
+        super().__init__(skip_empty)
+        self.path = str(path)
+        self.deduplicate = deduplicate is not None
+        self.tile_format = tile_format
+        self._queue = None
+        self._thread = None
+        self._error = None
+
+    def __getstate__(self):
+        """
+        Pickle the writer settings, the writer thread stays in its process.
+        """
+        state = super().__getstate__()
+        state.update(_queue=None, _thread=None, _error=None)
+        return state
+
+    def _create_schema(self, conn: sqlite3.Connection):
+        conn.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+        if self.deduplicate:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS map (
+                    zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT,
+                    PRIMARY KEY (zoom_level, tile_column, tile_row)
+                );
+                CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+                CREATE VIEW IF NOT EXISTS tiles AS
+                    SELECT map.zoom_level, map.tile_column, map.tile_row, images.tile_data
+                    FROM map JOIN images ON map.tile_id = images.tile_id;
+                """
+            )
+        else:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS tiles (
+                    zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB,
+                    PRIMARY KEY (zoom_level, tile_column, tile_row)
+                )
+                """
+            )
+
+    def _insert(self, conn: sqlite3.Connection, batch: list, hashes: set):
+        """
+        Insert a batch of tiles in a single transaction.
+        """
+        # MBTiles rows follow the TMS scheme, flipped from the XYZ scheme
+        rows = [
+            (int(tile.z), int(tile.x), (1 << int(tile.z)) - 1 - int(tile.y), payload)
+            for tile, payload in batch
+        ]
+        with conn:
+            if not self.deduplicate:
+                conn.executemany("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", rows)
+                for tile, _ in batch:
+                    self._count(tile.z, "written")
+                return
+
+            images, tile_ids = [], []
+            for tile, payload in batch:
+                digest = hashlib.blake2b(payload, digest_size=16).hexdigest()
+                tile_ids.append(digest)
+                if digest in hashes:
+                    self._count(tile.z, "duplicate")
+                else:
+                    hashes.add(digest)
+                    images.append((digest, payload))
+                    self._count(tile.z, "written")
+            conn.executemany("INSERT OR IGNORE INTO images VALUES (?, ?)", images)
+            conn.executemany(
+                "INSERT OR REPLACE INTO map VALUES (?, ?, ?, ?)",
+                [row[:3] + (tile_id,) for row, tile_id in zip(rows, tile_ids, strict=True)],
+            )
+
+    def _seed(self, conn: sqlite3.Connection, hashes: set):
+        """
+        Store the tiles kept from a previous run before the queued tiles, none by default.
+        """
+
+    def _write_metadata(self, conn: sqlite3.Connection):
+        """
+        Write the MBTiles metadata from the tiles stored in the file.
+        """
+        minzoom, maxzoom = conn.execute(
+            "SELECT MIN(zoom_level), MAX(zoom_level) FROM tiles"
+        ).fetchone()
+        if minzoom is None:
+            return
+        # Bounds of the tiles at the maximum zoom
+        xmin, xmax, rmin, rmax = conn.execute(
+            "SELECT MIN(tile_column), MAX(tile_column), MIN(tile_row), MAX(tile_row) FROM tiles "
+            "WHERE zoom_level = ?",
+            (maxzoom,),
+        ).fetchone()
+        west, _, _, north = mercantile.bounds(xmin, (1 << maxzoom) - 1 - rmax, maxzoom)
+        _, south, east, _ = mercantile.bounds(xmax, (1 << maxzoom) - 1 - rmin, maxzoom)
+        metadata = {
+            "name": Path(self.path).name.split(".")[0],
+            "format": self.tile_format,
+            "type": "overlay",
+            "minzoom": str(minzoom),
+            "maxzoom": str(maxzoom),
+            "bounds": f"{west},{south},{east},{north}",
+            "center": f"{(west + east) / 2},{(south + north) / 2},{minzoom}",
+        }
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)", metadata.items())
+
+    def _run(self):
+        """
+        Consume the queue until the end marker, inserting the tiles in batches.
+        """
+        if self.manifest is None:
+            # Only resumed runs add to the tiles of an existing file
+            self._remove()
+        conn = sqlite3.connect(self.path)
+        done = False
+        try:
+            self._create_schema(conn)
+            hashes = set()
+            if self.deduplicate:
+                hashes.update(row[0] for row in conn.execute("SELECT tile_id FROM images"))
+            self._seed(conn, hashes)
+
+            batch = []
+            while not done:
+                item = self._queue.get()
+                if item is None:
+                    done = True
+                else:
+                    batch.append(item)
+                if batch and (done or len(batch) >= self.BATCH_SIZE or self._queue.empty()):
+                    self._insert(conn, batch, hashes)
+                    # Tiles are complete once their transaction is committed
+                    if self.manifest is not None:
+                        self.manifest.add([tile for tile, _ in batch])
+                    batch = []
+            self._write_metadata(conn)
+        except Exception as e:
+            self._error = e
+            # Keep consuming so that producers never block on a full queue
+            while not done:
+                done = self._queue.get() is None
+        finally:
+            conn.close()
+
+    def write(self, tile: mercantile.Tile, payload: bytes, empty: bool = False):
+        """
+        Queue a tile for the writer thread.
+        """
+        if empty and self.skip_empty:
+            self._count(tile.z, "empty")
+            if self.manifest is not None:
+                self.manifest.add([tile])
+            return
+        with self._lock:
+            if self._thread is None:
+                self._queue = queue.Queue(maxsize=self.QUEUE_SIZE)
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._queue.put((tile, payload))
+
+    def _remove(self):
+        for suffix in ("", "-journal"):
+            Path(f"{self.path}{suffix}").unlink(missing_ok=True)
+
+    def close(self):
+        """
+        Wait for the queued tiles to be written and write the metadata.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+        elif self.manifest is None:
+            # No tiles, nothing left from previous runs either
+            self._remove()
+        if self._error is not None:
+            raise self._error
+
+
+class PMTilesWriter(MBTilesWriter):
+    """
+    Writes tiles into a single PMTiles file.
+
+    PMTiles need the tiles sorted by tile id, so they are first collected into a temporary
+    MBTiles file that is converted when the writer is closed. When resuming, the tiles of the
+    existing PMTiles file are copied into the temporary file first, so that the tiles completed
+    by previous runs are kept. Requires the `pmtiles` package.
+
+    Attributes:
+    path (str): The path of the PMTiles file.
+    skip_empty (bool, optional): Do not write fully transparent tiles. Defaults to False.
+    deduplicate (str, optional): Store identical tiles once if not None. Defaults to None.
+    tile_format (str, optional): The format of the tiles for the metadata. Defaults to "png".
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        skip_empty: bool = False,
+        deduplicate: str | None = None,
+        tile_format: str = "png",
+    ):
+        """
+        Initializes the PMTilesWriter class.
+        """
+        try:
+            import pmtiles  # noqa: F401
+        except ImportError as e:
+            raise ImportError("The 'pmtiles' output requires the pmtiles package.") from e
+
+        # PMTiles name JPEG tiles "jpeg" where MBTiles use "jpg"
+        tile_format = "jpeg" if tile_format == "jpg" else tile_format
+        super().__init__(f"{path}.mbtiles", skip_empty, deduplicate, tile_format)
+        self.pmtiles_path = str(path)
+
+    def _seed(self, conn: sqlite3.Connection, hashes: set):
+        """
+        Copy the tiles of the existing PMTiles file when resuming, without replacing the tiles
+        already in the temporary file, left by a run that did not complete.
+        """
+        from pmtiles.reader import MmapSource, all_tiles
+
+        if self.manifest is None or not os.path.isfile(self.pmtiles_path):
+            return
+        with open(self.pmtiles_path, "rb") as f, conn:
+            for (z, x, y), payload in all_tiles(MmapSource(f)):
+                # MBTiles rows follow the TMS scheme, flipped from the XYZ scheme
+                row = (z, x, (1 << z) - 1 - y)
+                if not self.deduplicate:
+                    conn.execute("INSERT OR IGNORE INTO tiles VALUES (?, ?, ?, ?)", (*row, payload))
+                    continue
+                digest = hashlib.blake2b(payload, digest_size=16).hexdigest()
+                if digest not in hashes:
+                    hashes.add(digest)
+                    conn.execute("INSERT OR IGNORE INTO images VALUES (?, ?)", (digest, payload))
+                conn.execute("INSERT OR IGNORE INTO map VALUES (?, ?, ?, ?)", (*row, digest))
+
+    def close(self):
+        """
+        Write the queued tiles and convert them to PMTiles.
+        """
+        from pmtiles.convert import mbtiles_to_pmtiles
+
+        super().close()
+        if os.path.isfile(self.path):
+            mbtiles_to_pmtiles(self.path, self.pmtiles_path, None)
+            os.remove(self.path)
+        elif self.manifest is None:
+            Path(self.pmtiles_path).unlink(missing_ok=True)
+
+
+def get_tile_writer(
+    output: str,
+    output_folder: Path,
+    skip_empty: bool = False,
+    deduplicate: str | None = None,
+    extension: str = "png",
+) -> TileWriter:
+    """
+    Return the writer of the given output.
+
+    Args:
+        output (str): "directory" for `{z}/{x}/{y}` files, or "mbtiles" or "pmtiles" for a
+            single archive named after the output folder and written inside it.
+        output_folder (str): The folder where the tiles will be exported.
+        skip_empty (bool, optional): Do not write fully transparent tiles. Defaults to False.
+        deduplicate (str, optional): Store identical tiles once. Defaults to None.
+        extension (str, optional): The file extension of the tiles. Defaults to "png".
+    """
+    if output == "directory":
+        return DirectoryTileWriter(output_folder, skip_empty, deduplicate, extension)
+
+    writer_class = {"mbtiles": MBTilesWriter, "pmtiles": PMTilesWriter}.get(output)
+    if not writer_class:
+        raise ValueError(f"Unsupported output: {output}")
+    os.makedirs(output_folder, exist_ok=True)
+    path = Path(output_folder) / f"{Path(output_folder).name}.{output}"
+    return writer_class(path, skip_empty, deduplicate, extension)
@@ -2,10 +2,27 @@
 This module contains the ZonalStatistics class.
 """
 
+import re
+from contextlib import contextmanager
+from itertools import pairwise
+
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import regionmask
+import shapely
 import xarray as xr
+from helpers.mask_cache import MaskCache, mask_key
+from scipy import sparse
+
+# Statistics computed from the sums and counts of every zone, besides the percentiles "p<q>"
+STATISTICS = ("mean", "sum", "count", "std", "min", "max")
+PERCENTILE = re.compile(r"^p(100|\d{1,2}(\.\d+)?)$")
+# How pixels are assigned to zones: whole pixels by their center, or by the fraction of their
+# area covered by every zone
+COVERAGES = ("center", "fractional")
+# Statistics computed from the weighted sums of the pixels, with a fractional coverage
+WEIGHTED_STATISTICS = ("mean", "sum", "count", "std")
 
 
 class ZonalStatistics:
@@ -17,14 +34,39 @@ class ZonalStatistics:
         The raster data.
     vector_data : gpd.GeoDataFrame
         The vector data.
+    statistics : list of str, optional
+        The statistics of every zone and time step, among "mean", "sum", "count" (of the valid
+        pixels), "std", "min", "max" and percentiles such as "p10" or "p99.5", all computed in
+        a single pass over the raster. The output has a column per statistic, the mean in
+        `x_axis_values` and the others named after the statistic. Defaults to the mean.
+    mask_cache : MaskCache, optional
+        An on-disk cache of the rasterized zones, keyed by the geometries and the grid, to
+        skip rasterizing the same zones on the same grid again. Defaults to None.
+    coverage : str, optional
+        "center" assigns every pixel to the zone containing its center. "fractional" weights
+        every pixel by the fraction of its area inside every zone, from the exact intersection
+        of the pixels with the geometries, so that small zones and their boundary pixels are
+        measured exactly. The count is then the weighted number of valid pixels, and only the
+        "mean", "sum", "count" and "std" statistics are supported. Defaults to "center".
+    n_workers : int, optional
+        With dask-backed raster data (e.g. a lazily opened Zarr archive), which is streamed a
+        chunk after the other, the number of worker processes of a local dask cluster reducing
+        the chunks, with the distributed package. Defaults to None, the current dask scheduler.
     """
 
+    # Values read at once (time steps x pixels), bounding the memory of a pass
+    BLOCK_SIZE = 2**24
+
     def __init__(
         self,
         raster_data: xr.Dataset,
         vector_data: gpd.GeoDataFrame,
         time_coord: str = "time",
         unit: str = None,
+        statistics: list[str] | None = None,
+        mask_cache: MaskCache | None = None,
+        coverage: str = "center",
+        n_workers: int | None = None,
     ) -> pd.DataFrame:
         """
         Initialize the ZonalStatistics object.
@@ -34,48 +76,465 @@ class ZonalStatistics:
         self.time_coord = time_coord
         self.unit = unit
         self.variable = list(self.raster_data.data_vars)[0]
+        self.statistics = list(statistics or ["mean"])
+        self.mask_cache = mask_cache
+        self.coverage = coverage
+        self.n_workers = n_workers
+        self.chunked = self.raster_data[self.variable].chunks is not None
+        if coverage not in COVERAGES:
+            raise ValueError(f"Unsupported coverage: {coverage}")
+        for stat in self.statistics:
+            if stat not in STATISTICS and not PERCENTILE.match(stat):
+                raise ValueError(f"Unsupported statistic: {stat}")
+            if coverage == "fractional" and stat not in WEIGHTED_STATISTICS:
+                raise ValueError(f"Unsupported statistic with fractional coverage: {stat}")
+            # Percentiles need every value of a zone at once
+            if self.chunked and PERCENTILE.match(stat):
+                raise ValueError(f"Unsupported statistic with chunked data: {stat}")
+        self.percentiles = {
+            stat: float(stat[1:]) for stat in self.statistics if PERCENTILE.match(stat)
+        }
+
+    def __getstate__(self):
+        """
+        Pickle the settings of the statistics without the data, for the dask workers reducing
+        the chunks.
+        """
+        state = self.__dict__.copy()
+        state.update(raster_data=None, vector_data=None, mask_cache=None)
+        return state
 
     def _rasterize_vector_data(self):
-        # Rasterize vector data
-        mask = regionmask.mask_geopandas(
-            self.vector_data, self.raster_data.x, self.raster_data.y, numbers="index"
-        )
+        x, y = self.raster_data.x, self.raster_data.y
+        key = mask_key(self.vector_data, x.values, y.values, "regionmask")
+        cached = self.mask_cache.get(key) if self.mask_cache is not None else None
+        if cached is not None:
+            mask = xr.DataArray(cached["mask"], coords={"y": y, "x": x}, dims=("y", "x"))
+        else:
+            # Rasterize vector data
+            mask = regionmask.mask_geopandas(self.vector_data, x, y, numbers="index")
+            if self.mask_cache is not None:
+                self.mask_cache.put(key, mask=mask.transpose("y", "x").values)
         # Add mask to raster data
         self.raster_data["mask"] = mask
 
-    def _compute_mean_value(self, group):
+    def _coverage_weights(self, zones: np.ndarray) -> sparse.csr_matrix:
         """
-        Compute the mean value for each group.
+        Return the fraction of the area of every pixel inside every zone, as a sparse matrix of
+        one row per zone and a column per pixel, flattened.
+
+        The pixels within the bounds of a geometry that it contains are weighted 1 at once,
+        only the pixels crossed by its boundary are intersected with it.
         """
-        bbox = group.total_bounds
-        ds_tmp = self.raster_data.sel(x=slice(bbox[0], bbox[2]), y=slice(bbox[3], bbox[1]))
-        mean_value = ds_tmp[self.variable].where(ds_tmp["mask"] == group.name).mean(["x", "y"])
-        return mean_value.values
+        x, y = self.raster_data.x.values, self.raster_data.y.values
+        key = mask_key(self.vector_data, x, y, "fractional")
+        cached = self.mask_cache.get(key) if self.mask_cache is not None else None
+        if cached is not None:
+            return sparse.csr_matrix(
+                (cached["data"], cached["indices"], cached["indptr"]), shape=tuple(cached["shape"])
+            )
 
-    def compute(self):
+        # Pixel edges, from the spacing of the pixel centers
+        x_half, y_half = np.abs(np.gradient(x)) / 2, np.abs(np.gradient(y)) / 2
+        left, right, bottom, top = x - x_half, x + x_half, y - y_half, y + y_half
+        rows, cols, weights = [np.empty(0, np.intp)], [np.empty(0, np.intp)], [np.empty(0)]
+        zone_codes = np.searchsorted(zones, self.vector_data["index"].to_numpy())
+        for zone, geometry in zip(zone_codes, self.vector_data.geometry.values, strict=True):
+            if geometry is None or geometry.is_empty:
+                continue
+            min_x, min_y, max_x, max_y = geometry.bounds
+            ys = np.flatnonzero((top > min_y) & (bottom < max_y))
+            xs = np.flatnonzero((right > min_x) & (left < max_x))
+            if not len(ys) or not len(xs):
+                continue
+            pixels = shapely.box(left[xs], bottom[ys, None], right[xs], top[ys, None]).ravel()
+            shapely.prepare(geometry)
+            fractions = shapely.contains_properly(geometry, pixels).astype(np.float64)
+            crossed = np.flatnonzero(fractions == 0)
+            crossed = crossed[shapely.intersects(geometry, pixels[crossed])]
+            fractions[crossed] = shapely.area(
+                shapely.intersection(geometry, pixels[crossed])
+            ) / shapely.area(pixels[crossed])
+            covered = np.flatnonzero(fractions > 0)
+            rows.append(np.full(len(covered), zone))
+            cols.append((ys[:, None] * len(x) + xs).ravel()[covered])
+            weights.append(fractions[covered])
+
+        # Geometries sharing a zone add up
+        shape = (len(zones), len(y) * len(x))
+        matrix = sparse.csr_matrix(
+            (np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))), shape=shape
+        )
+        if self.mask_cache is not None:
+            self.mask_cache.put(
+                key,
+                data=matrix.data,
+                indices=matrix.indices,
+                indptr=matrix.indptr,
+                shape=np.array(shape),
+            )
+        return matrix
+
+    def _compute_weighted_statistics(self, zones: np.ndarray) -> dict:
         """
-        Compute zonal statistics.
+        Compute the statistics of every zone at every time step from the fractional coverage of
+        the pixels.
+
+        The weight matrix is computed once and restricted to the pixels covered by any zone,
+        then every block of time steps is reduced with a single sparse product: of the values,
+        the valid pixels if any is NaN, and the squared values for the standard deviation.
+
+        Returns:
+        dict: The values of every statistic, one row per zone and a column per time step.
+        """
+        weights = self._coverage_weights(zones)
+        pixels = np.flatnonzero(weights.getnnz(axis=0))
+        weights = weights[:, pixels]
+
+        data = self.raster_data[self.variable].transpose(self.time_coord, "y", "x")
+        n_times = data.sizes[self.time_coord]
+        results = {stat: np.full((len(zones), n_times), np.nan) for stat in self.statistics}
+        step = max(1, self.BLOCK_SIZE // max(len(pixels), 1))
+        for start in range(0, n_times, step):
+            block = data.isel({self.time_coord: slice(start, start + step)}).values
+            block = block.reshape(len(block), -1)[:, pixels].T.astype(np.float64)
+            stats = self._weighted_statistics(self._weighted_sums(block, weights))
+            for stat in self.statistics:
+                results[stat][:, start : start + block.shape[1]] = stats[stat]
+
+        # Same types as computed by xarray, the count of fractional pixels being a float
+        dtype = data.dtype if data.dtype.kind == "f" else np.float64
+        return {
+            stat: value.astype(np.float64 if stat == "count" else dtype)
+            for stat, value in results.items()
+        }
+
+    def _weighted_sums(self, values: np.ndarray, weights: sparse.csr_matrix) -> dict:
+        """
+        Reduce the values of a block of time steps (a row per pixel) to the weighted counts of
+        valid pixels, sums and sums of squares of every zone, NaN pixels are skipped.
+        """
+        n = values.shape[1]
+        valid = ~np.isnan(values)
+        parts = [np.where(valid, values, 0)]
+        if not valid.all():
+            parts.append(valid.astype(np.float64))
+        if "std" in self.statistics:
+            parts.append(parts[0] ** 2)
+        products = weights @ np.hstack(parts)
+
+        if valid.all():
+            counts = np.asarray(weights.sum(axis=1)).repeat(n, 1)
+        else:
+            counts = products[:, n : 2 * n]
+        sums = {"count": counts, "sum": products[:, :n]}
+        if "std" in self.statistics:
+            sums["squares"] = products[:, -n:]
+        return sums
+
+    def _weighted_statistics(self, sums: dict) -> dict:
+        """
+        Return the weighted statistics of every zone from their weighted sums.
+        """
+        counts = sums["count"]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = np.where(counts > 0, sums["sum"] / counts, np.nan)
+            stats = {"count": counts, "sum": sums["sum"], "mean": means}
+            if "squares" in sums:
+                # Clipped for the rounding errors of constant zones
+                variances = np.maximum(sums["squares"] / counts - means**2, 0)
+                stats["std"] = np.sqrt(variances)
+        return stats
+
+    def _zone_codes(self, zones: np.ndarray) -> np.ndarray:
+        """
+        Return the position in `zones` of the zone of every pixel, flattened, and
+        `len(zones)` outside of every zone.
+        """
+        labels = self.raster_data["mask"].transpose("y", "x").values.ravel()
+        codes = np.full(labels.shape, len(zones), dtype=np.intp)
+        inside = ~np.isnan(labels)
+        codes[inside] = np.searchsorted(zones, labels[inside])
+        return codes
+
+    def _compute_statistics(self, zones: np.ndarray) -> dict:
+        """
+        Compute the statistics of every zone at every time step, in a single pass over the data.
+
+        The label grid is flattened once, then all the zones are reduced at once a time step
+        after the other, reading blocks of time steps: the sums, counts and squared deviations
+        with `bincount`, the minimum and maximum with `reduceat` over the pixels grouped by
+        zone, and the percentiles by sorting the values of every zone.
+
+        Returns:
+        dict: The values of every statistic, one row per zone and a column per time step.
+        """
+        codes = self._zone_codes(zones)
+        # One more bin for the pixels outside of every zone
+        sizes = np.bincount(codes, minlength=len(zones) + 1)
+        # The pixels inside a zone grouped by zone, for the order statistics
+        order = np.argsort(codes, kind="stable")[: sizes[:-1].sum()]
+
+        data = self.raster_data[self.variable].transpose(self.time_coord, "y", "x")
+        n_times = data.sizes[self.time_coord]
+        results = {stat: np.full((n_times, len(zones)), np.nan) for stat in self.statistics}
+        step = max(1, self.BLOCK_SIZE // len(codes))
+        for start in range(0, n_times, step):
+            block = data.isel({self.time_coord: slice(start, start + step)}).values
+            for t, values in enumerate(block.reshape(len(block), -1), start):
+                stats = self._reduce(values, codes, sizes, order)
+                for stat in self.statistics:
+                    results[stat][t] = stats[stat]
+
+        # Same types as computed by xarray
+        dtype = data.dtype if data.dtype.kind == "f" else np.float64
+        return {
+            stat: value.T.astype(np.int64 if stat == "count" else dtype)
+            for stat, value in results.items()
+        }
+
+    def _reduce(
+        self, values: np.ndarray, codes: np.ndarray, sizes: np.ndarray, order: np.ndarray
+    ) -> dict:
+        """
+        Reduce the values of a time step to the statistics of every zone, NaN pixels are
+        skipped as by xarray. The count, sum and mean are always returned.
+        """
+        n_bins = len(sizes)
+        valid = ~np.isnan(values)
+        if valid.all():
+            counts = sizes
+            sums = np.bincount(codes, weights=values, minlength=n_bins)
+        else:
+            counts = np.bincount(codes, weights=valid, minlength=n_bins)
+            sums = np.bincount(codes, weights=np.where(valid, values, 0), minlength=n_bins)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / counts
+        stats = {"count": counts[:-1], "sum": sums[:-1], "mean": means[:-1]}
+
+        if "std" in self.statistics:
+            deviations = np.where(valid, values - means[codes], 0) ** 2
+            with np.errstate(invalid="ignore", divide="ignore"):
+                variances = np.bincount(codes, weights=deviations, minlength=n_bins) / counts
+            stats["std"] = np.sqrt(variances[:-1])
+        if {"min", "max"} & set(self.statistics) or self.percentiles:
+            stats.update(self._order_statistics(values[order], sizes[:-1], counts[:-1]))
+        return stats
+
+    def _order_statistics(self, values: np.ndarray, sizes: np.ndarray, counts: np.ndarray):
+        """
+        Return the minimum, maximum and percentiles of every zone, from the values of the
+        pixels grouped by zone.
+        """
+        stats = {}
+        starts = np.cumsum(sizes) - sizes
+        # reduceat needs at least a pixel per zone
+        filled = sizes > 0
+        for stat, reduce in (("min", np.fmin), ("max", np.fmax)):
+            if stat in self.statistics:
+                stats[stat] = np.full(len(sizes), np.nan)
+                if filled.any():
+                    stats[stat][filled] = reduce.reduceat(values, starts[filled])
+        if self.percentiles:
+            # Sorted by value, the NaN pixels last, then stably by zone, which is a radix sort
+            # for 16-bit zone codes
+            zone = np.repeat(np.arange(len(sizes), dtype=np.min_scalar_type(len(sizes))), sizes)
+            by_value = np.argsort(values)
+            values = values[by_value[np.argsort(zone[by_value], kind="stable")]]
+            for stat, q in self.percentiles.items():
+                # Linear interpolation between the closest ranks, as numpy
+                rank = q / 100 * np.maximum(counts - 1, 0)
+                low = np.floor(rank).astype(np.intp)
+                high = np.minimum(low + 1, np.maximum(counts - 1, 0).astype(np.intp))
+                lower = values[np.minimum(starts + low, len(values) - 1)] if len(values) else 0
+                upper = values[np.minimum(starts + high, len(values) - 1)] if len(values) else 0
+                percentile = lower + (upper - lower) * (rank - low)
+                stats[stat] = np.where(counts > 0, percentile, np.nan)
+        return stats
+
+    def _compute_chunked_statistics(self, zones: np.ndarray) -> dict:
+        """
+        Compute the statistics of every zone at every time step from dask-backed data, streamed
+        a chunk after the other.
+
+        Every chunk of time steps and pixels covering any zone is reduced by a dask task to
+        partial statistics of every zone (the counts, sums, minimum and maximum, and the
+        squared deviations about the chunk means, or the weighted sums of squares with a
+        fractional coverage), which are merged over the spatial chunks of its time steps. Only
+        the chunks being reduced are in memory, chunks outside of every zone are not read.
+
+        Returns:
+        dict: The values of every statistic, one row per zone and a column per time step.
+        """
+        import dask
+
+        data = self.raster_data[self.variable].transpose(self.time_coord, "y", "x")
+        n_x = data.sizes["x"]
+        if self.coverage == "fractional":
+            # Sliced by pixels
+            pixels = self._coverage_weights(zones).tocsc()
+        else:
+            pixels = self._zone_codes(zones).reshape(data.sizes["y"], n_x)
+        blocks = data.data.to_delayed()
+        t_bounds, y_bounds, x_bounds = (np.cumsum((0, *chunks)) for chunks in data.chunks)
+
+        merged = []
+        for i, (t_start, t_end) in enumerate(pairwise(t_bounds)):
+            partials = []
+            for j, rows in enumerate(pairwise(y_bounds)):
+                for k, cols in enumerate(pairwise(x_bounds)):
+                    chunk_pixels = self._chunk_pixels(
+                        pixels, len(zones), slice(*rows), slice(*cols), n_x
+                    )
+                    if chunk_pixels is not None:
+                        partials.append(
+                            dask.delayed(self._reduce_chunk)(
+                                blocks[i, j, k], chunk_pixels, len(zones)
+                            )
+                        )
+            merged.append(
+                dask.delayed(self._merge_partials)(partials, len(zones), int(t_end - t_start))
+            )
+        with self._scheduler():
+            merged = dask.compute(*merged)
+        merged = {name: np.concatenate([m[name] for m in merged], axis=1) for name in merged[0]}
+
+        if self.coverage == "fractional":
+            stats = self._weighted_statistics(merged)
+        else:
+            counts, sums = merged["count"], merged["sum"]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                stats = {"count": counts, "sum": sums, "mean": sums / counts}
+                if "m2" in merged:
+                    stats["std"] = np.sqrt(merged["m2"] / counts)
+            stats.update({stat: merged[stat] for stat in ("min", "max") if stat in merged})
+
+        # Same types as computed in memory
+        dtype = data.dtype if data.dtype.kind == "f" else np.float64
+        count_dtype = np.float64 if self.coverage == "fractional" else np.int64
+        return {
+            stat: stats[stat].astype(count_dtype if stat == "count" else dtype)
+            for stat in self.statistics
+        }
+
+    def _chunk_pixels(self, pixels, n_zones: int, rows: slice, cols: slice, n_x: int):
+        """
+        Return the zone codes, or the weights, of the pixels of a chunk, None if they are
+        outside of every zone.
+        """
+        if self.coverage == "fractional":
+            columns = (
+                np.arange(rows.start, rows.stop)[:, None] * n_x + np.arange(cols.start, cols.stop)
+            ).ravel()
+            weights = pixels[:, columns].tocsr()
+            return weights if weights.nnz else None
+        codes = pixels[rows, cols].ravel()
+        return codes if (codes < n_zones).any() else None
+
+    def _reduce_chunk(self, block: np.ndarray, pixels, n_zones: int) -> dict:
+        """
+        Reduce a chunk of time steps and pixels to the partial statistics of every zone, a row
+        per zone and a column per time step.
+        """
+        values = block.reshape(len(block), -1)
+        if self.coverage == "fractional":
+            return self._weighted_sums(values.T.astype(np.float64), pixels)
+
+        sizes = np.bincount(pixels, minlength=n_zones + 1)
+        order = np.argsort(pixels, kind="stable")[: sizes[:-1].sum()]
+        steps = [self._reduce(step, pixels, sizes, order) for step in values]
+        names = [
+            "count",
+            "sum",
+            *(stat for stat in ("min", "max", "std") if stat in self.statistics),
+        ]
+        partial = {
+            name: np.stack([step[name] for step in steps], axis=1).astype(np.float64)
+            for name in names
+        }
+        if "std" in partial:
+            # Squared deviations about the chunk means, for merging
+            partial["m2"] = np.nan_to_num(partial.pop("std") ** 2 * partial["count"])
+        return partial
+
+    def _merge_partials(self, partials: list, n_zones: int, n_steps: int) -> dict:
+        """
+        Merge the partial statistics of the chunks of the same time steps.
         """
-        # Rasterize vector data
-        self._rasterize_vector_data()
-        # Compute the mean value for each geometry
-        mean_values = self.vector_data.groupby("index").apply(self._compute_mean_value)
+        names = ["count", "sum"]
+        if "std" in self.statistics:
+            names.append("squares" if self.coverage == "fractional" else "m2")
+        merged = {name: np.zeros((n_zones, n_steps)) for name in names}
+        for stat in ("min", "max"):
+            if stat in self.statistics:
+                merged[stat] = np.full((n_zones, n_steps), np.nan)
 
-        # Reset the index of mean_values
-        mean_values = mean_values.reset_index()
+        for partial in partials:
+            if "m2" in merged:
+                # Pairwise update of the squared deviations about the merged means
+                counts = merged["count"] + partial["count"]
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    delta = partial["sum"] / partial["count"] - merged["sum"] / merged["count"]
+                    shift = delta**2 * merged["count"] * partial["count"] / counts
+                merged["m2"] += partial["m2"] + np.nan_to_num(shift)
+            for name in ("count", "sum", "squares"):
+                if name in merged:
+                    merged[name] += partial[name]
+            for stat, reduce in (("min", np.fmin), ("max", np.fmax)):
+                if stat in merged:
+                    merged[stat] = reduce(merged[stat], partial[stat])
+        return merged
 
-        # Rename the columns of mean_values
-        mean_values.columns = ["index", "x_axis_values"]
+    @contextmanager
+    def _scheduler(self):
+        """
+        Run the dask computations in a local cluster of `n_workers` processes, if set.
+        """
+        if self.n_workers is None:
+            yield
+            return
+        try:
+            from dask.distributed import Client, LocalCluster
+        except ImportError as e:
+            raise ImportError("A local dask cluster requires the distributed package.") from e
+        with LocalCluster(n_workers=self.n_workers, threads_per_worker=1) as cluster:
+            with Client(cluster):
+                yield
+
+    def compute(self):
+        """
+        Compute zonal statistics.
+        """
+        # Compute the statistics for each geometry
+        zones = np.unique(self.vector_data["index"])
+        if self.coverage == "center":
+            # Rasterize vector data
+            self._rasterize_vector_data()
+        if self.chunked:
+            statistics = self._compute_chunked_statistics(zones)
+        elif self.coverage == "fractional":
+            statistics = self._compute_weighted_statistics(zones)
+        else:
+            statistics = self._compute_statistics(zones)
+        values = pd.DataFrame(
+            {
+                "index": zones,
+                **{
+                    "x_axis_values" if stat == "mean" else stat: list(value)
+                    for stat, value in statistics.items()
+                },
+            }
+        )
 
-        # Add y_axis_values to mean_values
-        mean_values["y_axis_values"] = str((self.raster_data[self.time_coord].values.tolist()))
+        # Add y_axis_values to values
+        values["y_axis_values"] = str((self.raster_data[self.time_coord].values.tolist()))
 
         # Add units
-        mean_values["x_axis_unit"] = self.time_coord
-        mean_values["y_axis_unit"] = self.unit
+        values["x_axis_unit"] = self.time_coord
+        values["y_axis_unit"] = self.unit
 
-        # Merge gdf and mean_values on 'index'
-        df = pd.merge(self.vector_data.drop(columns="geometry"), mean_values, on="index")
+        # Merge gdf and values on 'index'
+        df = pd.merge(self.vector_data.drop(columns="geometry"), values, on="index")
 
         df = df.drop(columns="index")
 